@@ -0,0 +1,335 @@
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+
+import configargparse
+from anyio import create_task_group
+
+import main
+import main_gui
+import register
+import writer
+from common import BatchSender
+from connection import Keepalive, ReconnectScheduler
+from credentials import Credentials
+from fanout import display_chat_fanout
+from mock_server import MockChatServer
+
+HOST = '127.0.0.1'
+
+
+def stamp(seq):
+    return f'{seq} {time.monotonic_ns()}'
+
+
+def read_stamp(text):
+    try:
+        return int(text.rsplit(' ', 1)[-1])
+    except ValueError:
+        return None
+
+
+class Probe:
+    def __init__(self):
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.expected = None
+
+    def record(self, text):
+        sent_at = read_stamp(text)
+        if sent_at is None:
+            return
+        self.latencies.append(time.monotonic_ns() - sent_at)
+        if self.expected and len(self.latencies) >= self.expected:
+            self.done.set()
+
+    async def wait(self, expected, timeout):
+        self.expected = expected
+        if len(self.latencies) >= expected:
+            return
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class StdoutProbe(Probe):
+    # stands in for sys.stdout to time every printed chat message
+
+    def write(self, text):
+        # the fan-out mode prints a whole batch at once
+        for line in text.split('\n'):
+            if line:
+                self.record(line)
+
+    def flush(self):
+        pass
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def report(name, count, elapsed, latencies, memory_peak):
+    return {
+        'scenario': name,
+        'messages': count,
+        'seconds': round(elapsed, 3),
+        'per_second': round(count / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.5) / 1e6, 3),
+        'p99_ms': round(percentile(latencies, 0.99) / 1e6, 3),
+        'memory_peak_kib': memory_peak,
+        'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+@contextmanager
+def measure_memory(enabled):
+    result = {'peak': None}
+    if enabled:
+        tracemalloc.start()
+    try:
+        yield result
+    finally:
+        if enabled:
+            result['peak'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+
+
+async def wait_for_readers(server, count=1, timeout=5):
+    deadline = time.monotonic() + timeout
+    while len(server.readers) < count:
+        if time.monotonic() > deadline:
+            raise TimeoutError('Client did not connect to the mock server')
+        await asyncio.sleep(0.01)
+
+
+async def cancel(task):
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+
+
+async def bench_display_chat(args, workdir, name='display_chat'):
+    server = MockChatServer()
+    port, _ = await server.start(HOST)
+    probe = StdoutProbe()
+    history = os.path.join(workdir, f'{name}.txt')
+    if name == 'display_chat':
+        coro = main.display_chat(HOST, port, history)
+    else:
+        coro = display_chat_fanout(HOST, port, history, args.workers)
+    stdout, sys.stdout = sys.stdout, probe
+    try:
+        with measure_memory(args.trace_memory) as memory:
+            task = asyncio.create_task(coro)
+            await wait_for_readers(server)
+            started = time.monotonic()
+            await server.generate_traffic(args.rate, args.count,
+                                          lambda seq: f'bench: {stamp(seq)}')
+            await probe.wait(args.count, args.timeout)
+            elapsed = time.monotonic() - started
+            await cancel(task)
+    finally:
+        sys.stdout = stdout
+        await server.close()
+    return report(name, len(probe.latencies), elapsed, probe.latencies,
+                  memory['peak'])
+
+
+async def bench_display_chat_fanout(args, workdir):
+    return await bench_display_chat(args, workdir, 'display_chat_fanout')
+
+
+async def pace(rate, started, seq):
+    if rate:
+        delay = started + seq / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def bench_submit_message(args, workdir):
+    probe = Probe()
+    server = MockChatServer(on_message=lambda nickname, text:
+                            probe.record(text))
+    _, writer_port = await server.start(HOST)
+    token = server.register('bench')['account_hash']
+    try:
+        with measure_memory(args.trace_memory) as memory:
+            started = time.monotonic()
+            for seq in range(args.calls):
+                await pace(args.rate, started, seq)
+                await writer.submit_message(HOST, writer_port, token,
+                                            stamp(seq))
+            await probe.wait(args.calls, args.timeout)
+            elapsed = time.monotonic() - started
+    finally:
+        await server.close()
+    return report('submit_message', len(probe.latencies), elapsed,
+                  probe.latencies, memory['peak'])
+
+
+async def bench_register(args, workdir):
+    server = MockChatServer()
+    _, writer_port = await server.start(HOST)
+    latencies = []
+    try:
+        with measure_memory(args.trace_memory) as memory, \
+                open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            started = time.monotonic()
+            for seq in range(args.calls):
+                await pace(args.rate, started, seq)
+                call_started = time.monotonic_ns()
+                await register.register(HOST, writer_port,
+                                        nickname='bench')
+                latencies.append(time.monotonic_ns() - call_started)
+            elapsed = time.monotonic() - started
+    finally:
+        await server.close()
+    return report('register', len(latencies), elapsed, latencies,
+                  memory['peak'])
+
+
+async def drain_queue(queue, on_message=None):
+    while True:
+        message = await queue.get()
+        if on_message:
+            on_message(message)
+
+
+async def bench_main_gui(args, workdir):
+    sent = Probe()
+    received = Probe()
+    server = MockChatServer(on_message=lambda nickname, text:
+                            sent.record(text))
+    port, writer_port = await server.start(HOST)
+    with open(os.path.join(workdir, '.token'), 'w') as f:
+        f.write(server.register('bench')['account_hash'])
+
+    messages_queue = asyncio.Queue()
+    sending_queue = asyncio.Queue()
+    other_queues = [asyncio.Queue() for _ in range(3)]
+    try:
+        with measure_memory(args.trace_memory) as memory:
+            async with create_task_group() as tg:
+                tg.start_soon(
+                    main_gui.handle_connection, HOST, port, writer_port,
+                    messages_queue, *other_queues, sending_queue,
+                    BatchSender(), Keepalive(), ReconnectScheduler(),
+                    ReconnectScheduler(), Credentials()
+                )
+                tg.start_soon(drain_queue, messages_queue, received.record)
+                for queue in other_queues:
+                    tg.start_soon(drain_queue, queue)
+                await wait_for_readers(server)
+
+                started = time.monotonic()
+                tg.start_soon(
+                    server.generate_traffic, args.rate, args.count,
+                    lambda seq: f'bench: {stamp(seq)}'
+                )
+                for seq in range(args.count):
+                    await pace(args.rate, started, seq)
+                    sending_queue.put_nowait(stamp(seq))
+                    if not args.rate and seq % 1000 == 999:
+                        await asyncio.sleep(0)
+                # every sent message is broadcast back to the reader too
+                await received.wait(args.count * 2, args.timeout)
+                await sent.wait(args.count, args.timeout)
+                elapsed = time.monotonic() - started
+                tg.cancel_scope.cancel()
+    finally:
+        await server.close()
+    return [
+        report('main_gui.read', len(received.latencies), elapsed,
+               received.latencies, memory['peak']),
+        report('main_gui.send', len(sent.latencies), elapsed,
+               sent.latencies, memory['peak']),
+    ]
+
+
+SCENARIOS = {
+    'display_chat': bench_display_chat,
+    'display_chat_fanout': bench_display_chat_fanout,
+    'submit_message': bench_submit_message,
+    'register': bench_register,
+    'main_gui': bench_main_gui,
+}
+
+
+async def run(args):
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # the clients read and write .token in the working directory
+        os.chdir(workdir)
+        try:
+            for name in args.scenarios.split(','):
+                result = await SCENARIOS[name](args, workdir)
+                results.extend(
+                    result if isinstance(result, list) else [result])
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def print_results(results):
+    columns = ['scenario', 'messages', 'seconds', 'per_second', 'p50_ms',
+               'p99_ms', 'memory_peak_kib', 'max_rss_kib']
+    print(' '.join(f'{column:>16}' for column in columns))
+    for result in results:
+        print(' '.join(f'{str(result[column]):>16}' for column in columns))
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--scenarios', type=str, default=','.join(SCENARIOS),
+        help=f'Comma separated scenarios out of: {", ".join(SCENARIOS)}'
+    )
+    parser.add_argument(
+        '--count', type=int, default=10000,
+        help='Messages per streaming scenario'
+    )
+    parser.add_argument(
+        '--calls', type=int, default=200,
+        help='Calls for the one connection per call scenarios'
+    )
+    parser.add_argument(
+        '--rate', type=float, default=0,
+        help='Messages or calls per second, 0 for as fast as possible'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Worker processes for the display_chat_fanout scenario'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=30,
+        help='Seconds to wait for the last message of a scenario'
+    )
+    parser.add_argument(
+        '--trace_memory', action='store_true',
+        help='Report the peak of Python allocations, slows the run down'
+    )
+    parser.add_argument(
+        '--output', type=str,
+        help='Also write the results as JSON to this file'
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,80 @@
+import datetime
+import re
+import statistics
+import time
+
+import configargparse
+
+from common import MessageStamper
+from fanout import format_batch, init_worker
+
+
+def old_stamp_each(lines, pattern):
+    # what the readers did before: a timestamp formatted for every message
+    messages = []
+    for line in lines:
+        if not line or (pattern and not pattern.search(line)):
+            continue
+        timestamp = datetime.datetime.now().strftime("%d.%m.%y %H.%M")
+        messages.append(f'[{timestamp}] {line}')
+    return messages
+
+
+def make_cases(pattern):
+    stamper = MessageStamper()
+    return {
+        'stamp_each (before)': lambda lines: old_stamp_each(lines, pattern),
+        'stamp': lambda lines: [stamper.stamp(line) for line in lines
+                                if line and (pattern is None or
+                                             pattern.search(line))],
+        'stamp_lines': lambda lines: stamper.stamp_lines(lines, pattern),
+    }
+
+
+def run_case(function, lines, rounds):
+    # like pytest-benchmark: many rounds, the spread is reported too
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        function(lines)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def report(name, timings, count):
+    per_message = [timing / count * 1e9 for timing in timings]
+    print(f'{name:>22} {min(per_message):>8.0f} '
+          f'{statistics.median(per_message):>8.0f} '
+          f'{max(per_message):>8.0f} '
+          f'{count / statistics.median(timings) / 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--count', type=int, default=50000,
+        help='Messages per round'
+    )
+    parser.add_argument(
+        '--rounds', type=int, default=20,
+        help='Rounds per case'
+    )
+    parser.add_argument(
+        '--filter', type=str, default=None,
+        help='Regular expression the messages are filtered with'
+    )
+    args = parser.parse_args()
+
+    pattern = re.compile(args.filter) if args.filter else None
+    lines = [f'user{seq % 97}: message number {seq}'
+             for seq in range(args.count)]
+    data = ('\n'.join(lines) + '\n').encode()
+
+    cases = make_cases(pattern)
+    init_worker(args.filter)
+    cases['format_batch (bytes)'] = lambda _: format_batch(data, time.time())
+
+    print(f'{"case":>22} {"min ns":>8} {"p50 ns":>8} {"max ns":>8} '
+          f'{"M msgs/s":>10}')
+    for name, function in cases.items():
+        report(name, run_case(function, lines, args.rounds), args.count)
@@ -0,0 +1,149 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+import configargparse
+
+# Milliseconds every entry point may spend importing on top of asyncio,
+# which all of them need and which is left out so the budgets do not
+# depend much on the machine.
+BUDGETS = {
+    'writer': 8,
+    'register': 25,
+    'main': 80,
+    'bots': 100,
+    'main_gui': 100,
+}
+# modules an entry point must not load on its way to the chat
+FORBIDDEN = {
+    'writer': ('tkinter', 'anyio', 'aiofiles', 'configargparse', 'sqlite3',
+               'multiprocessing'),
+    'register': ('tkinter', 'anyio', 'sqlite3'),
+    'main': ('tkinter', 'sqlite3', 'multiprocessing'),
+    'bots': ('tkinter', 'sqlite3', 'multiprocessing'),
+    'main_gui': ('tkinter', 'sqlite3', 'multiprocessing'),
+}
+BASELINE = 'asyncio'
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def closed_port():
+    # nothing listens there, so a client fails right after connecting
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def command_line(module, port):
+    # the CLI as a user runs it: the one-shot clients go as far as the
+    # connection, the long running ones only parse their arguments
+    chat = ['--host', '127.0.0.1', '--port', str(port)]
+    return {
+        'writer': chat + ['--message', 'startup'],
+        'register': chat,
+    }.get(module, ['--help'])
+
+
+def parse_importtime(stderr):
+    # {name: (self_us, cumulative_us, top_level)} from `python -X importtime`
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        top_level = not name.startswith('  ')
+        imports[name.strip()] = (int(self_us), int(cumulative_us), top_level)
+    return imports
+
+
+def trace_run(module, workdir, port):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime',
+         os.path.join(REPO, f'{module}.py'), *command_line(module, port)],
+        input='startup\n', capture_output=True, text=True, cwd=workdir
+    )
+    return parse_importtime(result.stderr)
+
+
+def trace_interpreter():
+    # what the interpreter loads before any script runs
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'pass'],
+        capture_output=True, text=True, check=True
+    )
+    return set(parse_importtime(result.stderr))
+
+
+def measure(module, runs, startup):
+    best = None
+    with tempfile.TemporaryDirectory() as workdir:
+        # the writer reads its token from the file like a user's one
+        with open(os.path.join(workdir, '.token'), 'w') as f:
+            f.write('startup')
+        port = closed_port()
+        for _ in range(runs):
+            imports = trace_run(module, workdir, port)
+            total = sum(cumulative_us for name, (_, cumulative_us, top_level)
+                        in imports.items()
+                        if top_level and name not in startup)
+            own = total - imports.get(BASELINE, (0, 0, True))[1]
+            if best is None or own < best[1]:
+                best = (total, own, imports)
+    return best
+
+
+def slowest(imports, count):
+    return sorted(imports.items(), key=lambda item: item[1][0],
+                  reverse=True)[:count]
+
+
+def check(modules, runs, scale, top):
+    failed = False
+    print(f'{"entry point":>12} {"run ms":>10} {"own ms":>8} '
+          f'{"budget ms":>10}')
+    startup = trace_interpreter()
+    for module in modules:
+        total, own, imports = measure(module, runs, startup)
+        budget = BUDGETS.get(module, float('inf')) * scale
+        print(f'{module:>12} {total / 1000:>10.1f} {own / 1000:>8.1f} '
+              f'{budget:>10.1f}')
+
+        problems = []
+        if own / 1000 > budget:
+            problems.append(f'over budget by {own / 1000 - budget:.1f} ms')
+        loaded = [name for name in FORBIDDEN.get(module, ())
+                  if name in imports]
+        if loaded:
+            problems.append(f'loads {", ".join(loaded)}')
+        if problems:
+            failed = True
+            print(f'  {module}: {"; ".join(problems)}, slowest imports:')
+            for name, (self_us, *_) in slowest(imports, top):
+                print(f'    {name:<40} {self_us / 1000:>7.1f} ms')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--modules', type=str, default=','.join(BUDGETS),
+        help=f'Comma separated entry points out of: {", ".join(BUDGETS)}'
+    )
+    parser.add_argument(
+        '--runs', type=int, default=5,
+        help='Imports per entry point, the fastest one counts'
+    )
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='Multiply all budgets, e.g. for slow CI machines'
+    )
+    parser.add_argument(
+        '--top', type=int, default=10,
+        help='Slowest imports listed for an entry point that fails'
+    )
+    args = parser.parse_args()
+
+    if check(args.modules.split(','), args.runs, args.scale, args.top):
+        sys.exit(1)
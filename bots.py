@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import resource
+import time
+
+import configargparse
+from anyio import create_task_group
+
+import events
+import main_gui
+from common import BatchSender, InvalidToken, add_send_arguments
+from connection import (Keepalive, ReconnectScheduler,
+                        add_keepalive_arguments, add_reconnect_arguments)
+from credentials import Credentials
+from history import DURABILITY_MODES, HistoryWriter
+from writer import read_file_messages, read_socket_messages
+
+logger = logging.getLogger('bots')
+
+
+def load_accounts(path):
+    # one account per line: "<name> <token>" or just "<token>"
+    accounts = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) == 1:
+                parts.insert(0, f'bot{number}')
+            accounts.append((parts[0], parts[1]))
+    return accounts
+
+
+def max_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class BotSession:
+    def __init__(self, name, token, sender, keepalive, scheduler):
+        self.name = name
+        self.credentials = Credentials(token=token)
+        self.sender = sender
+        self.keepalive = keepalive
+        self.scheduler = scheduler
+        self.sending_queue = asyncio.Queue()
+        self.status_updates_queue = asyncio.Queue()
+        self.status = 'connecting'
+        self.nickname = None
+        self.queued = 0
+        self.failed = False
+
+    @property
+    def delivered(self):
+        return (self.queued - self.sending_queue.qsize()
+                - self.sender.pending)
+
+    def post(self, message):
+        self.queued += 1
+        self.sending_queue.put_nowait(message)
+
+    async def track_status(self):
+        while True:
+            event = await self.status_updates_queue.get()
+            if isinstance(event, events.NicknameReceived):
+                self.nickname = event.nickname
+            elif isinstance(event, (events.SendingConnectionStateChanged,
+                                    events.ReconnectScheduled)):
+                self.status = event
+
+    async def run(self, host, writer_port, watchdog_queue):
+        try:
+            await main_gui.keep_sending(
+                host, writer_port, self.status_updates_queue, watchdog_queue,
+                self.sending_queue, self.sender, self.keepalive,
+                self.scheduler, self.credentials
+            )
+        except (OSError, InvalidToken, SystemExit) as e:
+            # a bad token must not take the other sessions down
+            self.failed = True
+            self.status = f'failed: {e!r}'
+            logger.error(f'Session {self.name} stopped: {e!r}')
+
+
+async def count_events(queue):
+    while True:
+        await queue.get()
+
+
+async def route_messages(sessions, messages):
+    # "<name> <message>" goes to one session, "* <message>" to all of them
+    by_name = {session.name: session for session in sessions}
+    async for line in messages:
+        name, _, message = line.partition(' ')
+        if not message:
+            continue
+        if name == '*':
+            for session in sessions:
+                session.post(message)
+        elif name in by_name:
+            by_name[name].post(message)
+        else:
+            logger.warning(f'Unknown session: {name}')
+
+
+async def generate_messages(session, rate):
+    started = time.monotonic()
+    seq = 0
+    while not session.failed:
+        delay = started + seq / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        session.post(f'{session.name} {seq}')
+        seq += 1
+
+
+def session_report(session):
+    return (f'{session.name} ({session.nickname or "?"}): {session.status}, '
+            f'delivered {session.delivered}, '
+            f'pending {session.queued - session.delivered}, '
+            f'reconnects {session.scheduler.reconnects}')
+
+
+async def report(sessions, interval, baseline_rss):
+    delivered = 0
+    last = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        total = sum(session.delivered for session in sessions)
+        connected = sum(
+            session.status is events.SendingConnectionStateChanged.ESTABLISHED
+            for session in sessions
+        )
+        rss = max_rss_kib()
+        logger.info(
+            f'{connected}/{len(sessions)} sessions connected, '
+            f'{(total - delivered) / (now - last):.1f} messages/s, '
+            f'{total} delivered, max RSS {rss} KiB '
+            f'(~{(rss - baseline_rss) / max(len(sessions), 1):.1f} KiB '
+            f'per session)'
+        )
+        for session in sessions:
+            logger.debug(session_report(session))
+        delivered, last = total, now
+
+
+def make_scheduler(args):
+    return ReconnectScheduler(args.reconnect_base_delay,
+                              args.reconnect_max_delay,
+                              args.circuit_failure_threshold,
+                              args.circuit_cooldown)
+
+
+async def run_bots(args):
+    baseline_rss = max_rss_kib()
+    sessions = [
+        BotSession(
+            name, token,
+            BatchSender(args.send_batch_size, args.send_high_water,
+                        args.send_rate_limit),
+            Keepalive(args.keepalive_interval, args.keepalive_min_timeout,
+                      args.keepalive_max_timeout),
+            make_scheduler(args)
+        )
+        for name, token in load_accounts(args.accounts)
+    ]
+    watchdog_queue = asyncio.Queue()
+
+    try:
+        async with create_task_group() as tg:
+            tg.start_soon(count_events, watchdog_queue)
+            tg.start_soon(report, sessions, args.report_interval,
+                          baseline_rss)
+            for session in sessions:
+                tg.start_soon(session.track_status)
+                tg.start_soon(session.run, args.host, args.writer_port,
+                              watchdog_queue)
+                if args.rate:
+                    tg.start_soon(generate_messages, session, args.rate)
+
+            if args.history:
+                # one shared reading connection is enough for all bots
+                messages_queue = asyncio.Queue()
+                messages_history_queue = asyncio.Queue()
+                reader_status_queue = asyncio.Queue()
+                history_writer = HistoryWriter(
+                    args.history, messages_history_queue,
+                    durability=args.history_durability)
+                tg.start_soon(history_writer.run)
+                tg.start_soon(count_events, messages_queue)
+                tg.start_soon(count_events, reader_status_queue)
+                tg.start_soon(
+                    main_gui.keep_reading, args.host, args.port,
+                    messages_queue, messages_history_queue, reader_status_queue,
+                    watchdog_queue, make_scheduler(args)
+                )
+
+            if args.file:
+                tg.start_soon(route_messages, sessions,
+                              read_file_messages(args.file))
+            if args.socket:
+                tg.start_soon(route_messages, sessions,
+                              read_socket_messages(args.socket))
+    finally:
+        for session in sessions:
+            logger.info(session_report(session))
+
+
+def parse_args():
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--accounts', type=str, required=True,
+        help='File with one "<name> <token>" per line', env_var='BOTS_ACCOUNTS'
+    )
+    parser.add_argument('--host', type=str,
+        help='Host address', env_var='MAIN_HOST', default='minechat.dvmn.org')
+    parser.add_argument(
+        '--port', type=int, help='Host port', env_var='MAIN_PORT',
+        default=5000
+    )
+    parser.add_argument(
+        '--writer_port', type=int, help='Writer Host port',
+        env_var='WRITER_PORT', default=5050
+    )
+    parser.add_argument(
+        '--history', type=str,
+        help='Read the chat once for all bots and save it to this file',
+        env_var='HISTORY_PATH'
+    )
+    parser.add_argument(
+        '--history_durability', type=str, default='flush',
+        choices=DURABILITY_MODES,
+        help='What to do after each history batch: none, flush or fsync',
+        env_var='HISTORY_DURABILITY'
+    )
+    parser.add_argument(
+        '--file', type=str,
+        help='Read "<name> <message>" lines from the file, - for stdin'
+    )
+    parser.add_argument(
+        '--socket', type=str,
+        help='Read "<name> <message>" lines from a UNIX socket'
+    )
+    parser.add_argument(
+        '--rate', type=float, default=0,
+        help='Make every bot post this many generated messages per second'
+    )
+    parser.add_argument(
+        '--report_interval', type=float, default=10.0,
+        help='Seconds between throughput and memory reports'
+    )
+    add_send_arguments(parser)
+    add_keepalive_arguments(parser)
+    add_reconnect_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig(
+        format=(
+            '%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s] '
+            '%(message)s'
+        ),
+        level=logging.INFO
+    )
+
+    try:
+        asyncio.run(run_bots(args))
+    except KeyboardInterrupt:
+        logger.info('Exit the bots with CTRL+C')
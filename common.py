@@ -1,14 +1,47 @@
 import asyncio
+import codecs
+import os
+import stat
+import sys
+import time
+from collections import deque
 from contextlib import asynccontextmanager
 
+import metrics
+
+CHUNK_SIZE = 64 * 1024
+# the server answers every posted message with this line
+MESSAGE_SENT = 'Message send. Write more'
+# stands for a keepalive probe in the unacked messages, the server answers
+# a probe the same way as a message
+PROBE = object()
+# the readers put "[dd.mm.yy HH.MM] " in front of every message
+TIMESTAMP_FORMAT = '%d.%m.%y %H.%M'
+
 
 class MessageFormatError(AttributeError):
     pass
 
 
+class InvalidToken(Exception):
+    pass
+
+
+class ChatTimeout(ConnectionError):
+    pass
+
+
+async def open_connection(host, port, timeout=None):
+    try:
+        return await asyncio.wait_for(asyncio.open_connection(host, port),
+                                      timeout)
+    except asyncio.TimeoutError:
+        raise ChatTimeout(f'No connection to {host}:{port} in {timeout}s')
+
+
 @asynccontextmanager
-async def manage_socket(host, port):
-    reader, writer = await asyncio.open_connection(host, port)
+async def manage_socket(host, port, timeout=None):
+    reader, writer = await open_connection(host, port, timeout)
     try:
         yield reader, writer
     finally:
@@ -18,8 +51,365 @@ async def manage_socket(host, port):
 
 async def write_to_socket(writer, messages):
     try:
-        for message in messages:
-            writer.write(message.encode())
-    except AttributeError:
+        writer.write(''.join(messages).encode())
+    except (AttributeError, TypeError):
         raise MessageFormatError
     await writer.drain()
+
+
+def frame_messages(messages):
+    # a chat message is finished by an empty line
+    try:
+        return ('\n\n'.join(messages) + '\n\n').encode()
+    except TypeError:
+        raise MessageFormatError
+
+
+class BatchSender:
+    # Sends everything that piled up in a queue as one write and waits for
+    # the socket buffer only when it is above the high-water mark. An
+    # optional rate limit (messages per second) works as a token bucket
+    # that allows bursts of up to one second worth of messages.
+    # Messages stay in `unacked` until the server confirms them, so the
+    # ones lost with a broken connection can be sent again.
+
+    def __init__(self, batch_size=100, high_water=64 * 1024,
+                 rate_limit=None):
+        self.batch_size = batch_size
+        self.high_water = high_water
+        self.rate_limit = rate_limit
+        self._tokens = rate_limit or 0
+        self._updated = None
+        self.unacked = deque()
+        # probes waiting for their answer among the unacked messages
+        self._probes = 0
+        # called with every message the server confirmed, in sending order
+        self.on_ack = None
+        # when every unacked batch went out: [time, messages not acked]
+        self._sent_at = deque()
+
+        self._sent = metrics.counter(
+            'chat_messages_sent_total', 'Messages written to the socket')
+        self._batch_sizes = metrics.histogram(
+            'chat_send_batch_messages', 'Messages per write',
+            metrics.SIZE_BUCKETS)
+        self._send_latency = metrics.histogram(
+            'chat_send_seconds', 'Time to write a batch, drain included')
+        self._ack_latency = metrics.histogram(
+            'chat_ack_seconds',
+            'Time from writing a batch to the confirmation of all of it')
+
+    async def _available(self, wanted):
+        # waits for at least one token, they are spent only for the
+        # messages actually collected
+        if not self.rate_limit:
+            return wanted
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._updated is not None:
+                self._tokens = min(
+                    self.rate_limit,
+                    self._tokens + (now - self._updated) * self.rate_limit
+                )
+            self._updated = now
+            if self._tokens >= 1:
+                return min(wanted, int(self._tokens))
+            await asyncio.sleep((1 - self._tokens) / self.rate_limit)
+
+    async def collect(self, queue):
+        # the token comes first: a task cancelled while it waits must not
+        # have taken a message out of the queue yet
+        await self._available(1)
+        batch = [await queue.get()]
+        # the token is still there, this does not wait
+        allowed = await self._available(self.batch_size)
+        while len(batch) < allowed:
+            try:
+                batch.append(queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        if self.rate_limit:
+            self._tokens -= len(batch)
+        return batch
+
+    async def send(self, writer, batch):
+        started = time.perf_counter()
+        data = frame_messages(batch)
+        self.unacked.extend(batch)
+        self._sent_at.append([started, len(batch)])
+        if writer.is_closing():
+            raise ConnectionResetError('Connection is closed')
+        writer.write(data)
+        if writer.transport.get_write_buffer_size() >= self.high_water:
+            await writer.drain()
+        self._sent.inc(len(batch))
+        self._batch_sizes.observe(len(batch))
+        self._send_latency.observe(time.perf_counter() - started)
+
+    @property
+    def pending(self):
+        # messages not confirmed yet, probes left out
+        return len(self.unacked) - self._probes
+
+    async def probe(self, writer):
+        # goes after everything already written, so its answer comes in
+        # the same order and does not confirm a message
+        self.unacked.append(PROBE)
+        self._probes += 1
+        await write_to_socket(writer, ['\n'])
+
+    def on_response(self, line):
+        if line.startswith(MESSAGE_SENT) and self.unacked:
+            message = self.unacked.popleft()
+            if message is PROBE:
+                self._probes -= 1
+                return
+            if self.on_ack:
+                self.on_ack(message)
+            sent_at = self._sent_at[0]
+            sent_at[1] -= 1
+            if not sent_at[1]:
+                self._sent_at.popleft()
+                self._ack_latency.observe(time.perf_counter() - sent_at[0])
+
+    async def resend(self, writer):
+        # delivery is at least once: a message may have reached the server
+        # right before its connection broke and will come again
+        # probes of the broken connection are not answered any more
+        batch = [message for message in self.unacked if message is not PROBE]
+        self.unacked.clear()
+        self._probes = 0
+        self._sent_at.clear()
+        if batch:
+            await self.send(writer, batch)
+
+
+def add_send_arguments(parser):
+    # the BatchSender options shared by every client that posts messages
+    parser.add_argument(
+        '--send_batch_size', type=int, default=100,
+        help='Max number of messages sent in one write',
+        env_var='SEND_BATCH_SIZE'
+    )
+    parser.add_argument(
+        '--send_high_water', type=int, default=64 * 1024,
+        help='Wait for the socket to drain only above this many buffered '
+             'bytes', env_var='SEND_HIGH_WATER'
+    )
+    parser.add_argument(
+        '--send_rate_limit', type=float, default=None,
+        help='Max messages sent per second on a connection',
+        env_var='SEND_RATE_LIMIT'
+    )
+
+
+class LineReader:
+    # Reads big chunks and yields complete lines. Decoding is incremental,
+    # so a multi-byte character cut by a chunk boundary is never broken,
+    # and the unfinished last line waits for the rest of it.
+
+    def __init__(self, reader, chunk_size=CHUNK_SIZE, encoding='utf-8',
+                 stage='other'):
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder(encoding)(
+            errors='replace')
+        self._tail = []
+        self._lines = deque()
+        self.at_eof = False
+
+        self._bytes = metrics.counter(
+            'chat_bytes_read_total', 'Bytes read from a socket', stage=stage)
+        self._lines_read = metrics.counter(
+            'chat_lines_read_total', 'Complete lines read from a socket',
+            stage=stage)
+        self._framing = metrics.histogram(
+            'chat_framing_seconds', 'Time to decode a chunk and split it '
+            'into lines', stage=stage)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._lines:
+            self._lines.extend(await self.read_lines())
+            if not self._lines:
+                raise StopAsyncIteration
+        return self._lines.popleft()
+
+    async def readline(self):
+        try:
+            return await self.__anext__()
+        except StopAsyncIteration:
+            raise ConnectionResetError('Connection closed by the server')
+
+    async def read_lines(self):
+        # an empty list means the stream is over
+        if self._lines:
+            lines = list(self._lines)
+            self._lines.clear()
+            return lines
+
+        while not self.at_eof:
+            chunk = await self.reader.read(self.chunk_size)
+            started = time.perf_counter()
+            self._bytes.inc(len(chunk))
+            if not chunk:
+                self.at_eof = True
+                text = self._decoder.decode(b'', final=True)
+            else:
+                text = self._decoder.decode(chunk)
+                if '\n' not in text:
+                    self._tail.append(text)
+                    continue
+
+            if self._tail:
+                self._tail.append(text)
+                text = ''.join(self._tail)
+                self._tail.clear()
+
+            lines = text.split('\n')
+            tail = lines.pop()
+            if tail:
+                if self.at_eof:
+                    lines.append(tail)
+                else:
+                    self._tail.append(tail)
+            self._framing.observe(time.perf_counter() - started)
+            if lines:
+                self._lines_read.inc(len(lines))
+                return lines
+        return []
+
+
+class MessageStamper:
+    # Puts the time of arrival in front of chat messages. The timestamp has
+    # minute resolution, so the prefix is formatted once a minute and every
+    # message in between only gets concatenated to it.
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._minute = None
+        self._prefix = ''
+
+    def prefix(self, now=None):
+        if now is None:
+            now = self.clock()
+        minute = int(now // 60)
+        if minute != self._minute:
+            self._minute = minute
+            stamp = time.strftime(TIMESTAMP_FORMAT, time.localtime(now))
+            self._prefix = f'[{stamp}] '
+        return self._prefix
+
+    def stamp(self, message, now=None):
+        return self.prefix(now) + message
+
+    def stamp_lines(self, lines, pattern=None, now=None):
+        # a block of lines received together, empty ones are skipped
+        prefix = self.prefix(now)
+        if pattern is None:
+            return [prefix + line for line in lines if line]
+        return [prefix + line for line in lines
+                if line and pattern.search(line)]
+
+
+async def read_answer(lines):
+    answer = ''
+    while not answer.strip():
+        answer = await lines.readline()
+    return answer
+
+
+class ChatSession:
+    # The chat protocol over one connection: the greeting, logging in with a
+    # token or registering a nickname, posting messages and reading lines.
+    # Every step of the handshake has to finish in `timeout` seconds, the
+    # messages are read for as long as they come.
+
+    def __init__(self, reader, writer, timeout=10.0, stage='other'):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.lines = LineReader(reader, stage=stage)
+        self.account = None
+
+    async def _wait(self, coro, step):
+        try:
+            return await asyncio.wait_for(coro, self.timeout)
+        except asyncio.TimeoutError:
+            raise ChatTimeout(f'No {step} in {self.timeout}s')
+
+    async def read_greeting(self):
+        return await self._wait(self.lines.readline(), 'greeting')
+
+    async def _read_account(self):
+        import json
+
+        answer = await self._wait(read_answer(self.lines), 'answer')
+        # null for an unknown token, raises ValueError for anything else
+        self.account = json.loads(answer)
+        return self.account
+
+    async def login(self, token, greeting=True):
+        # with greeting=False the caller has read the greeting already
+        if greeting:
+            await self.read_greeting()
+        if not token or '\n' in token:
+            raise InvalidToken('No valid token')
+        await write_to_socket(self.writer, [token, '\n'])
+        if not await self._read_account():
+            raise InvalidToken('Unknown token')
+        return self.account
+
+    async def register(self, nickname, greeting=True):
+        if greeting:
+            await self.read_greeting()
+        # an empty token asks for a new account
+        await write_to_socket(self.writer, ['\n'])
+        await self._wait(self.lines.readline(), 'nickname prompt')
+        await write_to_socket(self.writer, [nickname.replace('\n', ' '), '\n'])
+        return await self._read_account()
+
+    async def send(self, *messages):
+        self.writer.write(frame_messages(messages))
+        await self.writer.drain()
+
+    async def read_batch(self):
+        # every line that arrived together, an empty list at the end
+        return await self.lines.read_lines()
+
+    def iter_messages(self):
+        return self.lines
+
+
+@asynccontextmanager
+async def open_session(host, port, timeout=10.0, stage='other'):
+    async with manage_socket(host, port, timeout) as (reader, writer):
+        yield ChatSession(reader, writer, timeout, stage)
+
+
+class StdinReader:
+    # Lines of stdin without blocking the event loop. A pipe, a socket or
+    # a terminal is watched by the loop; regular files and /dev/null can
+    # not be, but reading them is never slow either.
+
+    def __init__(self):
+        self._reader = None
+        mode = os.fstat(sys.stdin.fileno()).st_mode
+        self._pipe = (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+                      or sys.stdin.isatty())
+
+    async def readline(self):
+        # None at the end of the input
+        if not self._pipe:
+            line = sys.stdin.readline()
+        else:
+            if self._reader is None:
+                self._reader = asyncio.StreamReader()
+                await asyncio.get_running_loop().connect_read_pipe(
+                    lambda: asyncio.StreamReaderProtocol(self._reader),
+                    sys.stdin)
+            line = (await self._reader.readline()).decode(errors='replace')
+        return line.rstrip('\n') if line else None
@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import random
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class KeepaliveTimeout(ConnectionError):
+    pass
+
+
+class Keepalive:
+    # Probes the writer connection only after it has been quiet for
+    # `interval` seconds: any answer from the server proves the link is
+    # alive. The probe timeout follows the measured round-trip time the
+    # way TCP computes its retransmission timeout (RFC 6298).
+
+    def __init__(self, interval=5.0, min_timeout=1.0, max_timeout=10.0):
+        self.interval = interval
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+        self.srtt = None
+        self.rttvar = None
+        self.last_rtt = None
+        self.min_rtt = None
+        self.max_rtt = None
+        self.samples = 0
+        self.probes = 0
+        self.timeouts = 0
+
+        self._last_seen = None
+        self._probe_sent = None
+        self._answered = asyncio.Event()
+
+        self._rtt = metrics.histogram(
+            'chat_keepalive_rtt_seconds', 'Round trip of keepalive probes')
+        self._timeouts = metrics.counter(
+            'chat_keepalive_timeouts_total', 'Unanswered keepalive probes')
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            return self.max_timeout
+        return min(max(self.srtt + 4 * self.rttvar, self.min_timeout),
+                   self.max_timeout)
+
+    def _add_sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.last_rtt = rtt
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.max_rtt = rtt if self.max_rtt is None else max(self.max_rtt, rtt)
+        self.samples += 1
+        self._rtt.observe(rtt)
+        logger.debug(f'Keepalive RTT {rtt * 1000:.1f} ms, '
+                     f'smoothed {self.srtt * 1000:.1f} ms')
+
+    def on_data(self):
+        # to be called whenever anything arrives on the watched connection
+        now = asyncio.get_running_loop().time()
+        self._last_seen = now
+        if self._probe_sent is not None:
+            self._add_sample(now - self._probe_sent)
+            self._probe_sent = None
+        self._answered.set()
+
+    def stats(self):
+        return {
+            'rtt_last': self.last_rtt,
+            'rtt_smoothed': self.srtt,
+            'rtt_min': self.min_rtt,
+            'rtt_max': self.max_rtt,
+            'rtt_samples': self.samples,
+            'probes': self.probes,
+            'timeouts': self.timeouts,
+        }
+
+    async def run(self, writer, sender):
+        loop = asyncio.get_running_loop()
+        self._last_seen = loop.time()
+        self._probe_sent = None
+
+        while True:
+            idle = loop.time() - self._last_seen
+            if idle < self.interval:
+                await asyncio.sleep(self.interval - idle)
+                continue
+
+            timeout = self.timeout
+            self._answered.clear()
+            self._probe_sent = loop.time()
+            self.probes += 1
+            # an empty line is an empty message, the server answers it
+            await sender.probe(writer)
+            try:
+                await asyncio.wait_for(self._answered.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self._timeouts.inc()
+                raise KeepaliveTimeout(
+                    f'No answer to keepalive in {timeout:.2f}s')
+
+
+class IdleWatch:
+    # Tells when a stream goes quiet for `timeout` seconds and when data
+    # comes again. Data only moves the deadline: the one sleeping task wakes
+    # up at the old deadline, sees the new one and sleeps again, and once
+    # the stream is idle it just waits for the next data.
+
+    def __init__(self, timeout, on_idle, on_active):
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.on_active = on_active
+        # nothing arrived yet
+        self.idle = True
+        self._last_seen = None
+        self._active = asyncio.Event()
+
+    def on_data(self):
+        self._last_seen = asyncio.get_running_loop().time()
+        if self.idle:
+            self.idle = False
+            self._active.set()
+            self.on_active()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.idle:
+                self._active.clear()
+                await self._active.wait()
+                continue
+            quiet = loop.time() - self._last_seen
+            if quiet < self.timeout:
+                await asyncio.sleep(self.timeout - quiet)
+                continue
+            self.idle = True
+            self.on_idle()
+
+
+class ReconnectScheduler:
+    # Exponential backoff with jitter between reconnects plus a circuit
+    # breaker: after `failure_threshold` short-lived connections in a row
+    # the circuit opens and only one attempt per `cooldown` is made until
+    # a connection stays up for `stable_after` seconds again.
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, base_delay=0.5, max_delay=30.0, failure_threshold=8,
+                 cooldown=60.0, stable_after=10.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.stable_after = stable_after
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.reconnects = 0
+
+    def on_disconnect(self, uptime):
+        if uptime >= self.stable_after:
+            self.failures = 0
+            self.state = self.CLOSED
+        self.failures += 1
+        self.reconnects += 1
+        if self.state == self.HALF_OPEN or \
+                self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+
+    def next_delay(self):
+        if self.state == self.OPEN:
+            # the attempt after the cooldown decides whether to close it
+            self.state = self.HALF_OPEN
+            return self.cooldown
+        # the exponent stops growing long after the delay reached max_delay,
+        # a float power overflows after about a thousand failures
+        doublings = min(self.failures - 1, 32)
+        cap = min(self.max_delay, self.base_delay * 2 ** doublings)
+        # "equal jitter": never retry instantly, never all at the same time
+        return cap / 2 + random.uniform(0, cap / 2)
+
+
+def add_keepalive_arguments(parser):
+    parser.add_argument(
+        '--keepalive_interval', type=float, default=5.0,
+        help='Probe the writer connection after this many quiet seconds',
+        env_var='KEEPALIVE_INTERVAL'
+    )
+    parser.add_argument(
+        '--keepalive_min_timeout', type=float, default=1.0,
+        help='Lower bound of the RTT based keepalive timeout',
+        env_var='KEEPALIVE_MIN_TIMEOUT'
+    )
+    parser.add_argument(
+        '--keepalive_max_timeout', type=float, default=10.0,
+        help='Upper bound of the RTT based keepalive timeout',
+        env_var='KEEPALIVE_MAX_TIMEOUT'
+    )
+
+
+def add_reconnect_arguments(parser):
+    parser.add_argument(
+        '--reconnect_base_delay', type=float, default=0.5,
+        help='Delay before the first reconnect, doubled after each failure',
+        env_var='RECONNECT_BASE_DELAY'
+    )
+    parser.add_argument(
+        '--reconnect_max_delay', type=float, default=30.0,
+        help='Max delay between reconnects', env_var='RECONNECT_MAX_DELAY'
+    )
+    parser.add_argument(
+        '--circuit_failure_threshold', type=int, default=8,
+        help='Failed connections in a row that open the circuit',
+        env_var='CIRCUIT_FAILURE_THRESHOLD'
+    )
+    parser.add_argument(
+        '--circuit_cooldown', type=float, default=60.0,
+        help='Seconds between attempts while the circuit is open',
+        env_var='CIRCUIT_COOLDOWN'
+    )
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def token_path(profile=None):
+    return f'.token.{profile}' if profile else '.token'
+
+
+def read_token(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def write_token(path, token):
+    with open(path, 'w') as f:
+        f.write(token)
+
+
+class Credentials:
+    # In-process cache of tokens and nicknames. A token file is read again
+    # only after its mtime or size changed, and the nickname of the last
+    # successful login is kept so it can be shown before the next one.
+
+    def __init__(self, profile=None, token=None):
+        self.profile = profile
+        # a token given up front (e.g. by the bot runner) skips the files
+        self.token = token
+        self._tokens = {}
+        self._nicknames = {}
+
+    async def get_token(self, profile=None):
+        if self.token is not None and profile is None:
+            return self.token
+        path = token_path(profile or self.profile)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            logger.error('File with token was not found')
+            self._tokens.pop(path, None)
+            return None
+
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._tokens.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        # a token file is a few dozen bytes: read in place it costs less
+        # than starting aiofiles or a thread pool on the writer's cold start
+        token = read_token(path)
+        self._tokens[path] = (version, token)
+        return token
+
+    async def save_token(self, token, profile=None):
+        path = token_path(profile or self.profile)
+        await asyncio.to_thread(write_token, path, token)
+        self._tokens.pop(path, None)
+
+    def remember_nickname(self, token, nickname):
+        self._nicknames[token] = nickname
+
+    def get_nickname(self, token):
+        return self._nicknames.get(token)
@@ -0,0 +1,70 @@
+import socket
+import sys
+
+# Thin client of `writer.py --daemon`: no asyncio and no chat login, only a
+# UNIX socket. The daemon answers every line with "ok" once the chat server
+# has confirmed the message, in the order the lines were sent.
+
+ACK = b'ok\n'
+
+
+def split_lines(messages):
+    # the daemon takes every non-empty line as a message
+    return [line for message in messages
+            for line in message.split('\n') if line]
+
+
+def post_messages(path, messages, timeout=30.0):
+    # returns how many of the messages were delivered
+    lines = split_lines(messages)
+    if not lines:
+        return 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(''.join(f'{line}\n' for line in lines).encode())
+        sock.shutdown(socket.SHUT_WR)
+
+        acked = 0
+        received = b''
+        while acked < len(lines):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            received += chunk
+            acked += received.count(ACK)
+            received = received[received.rfind(b'\n') + 1:]
+    return acked
+
+
+def post_or_exit(path, messages, timeout=30.0):
+    expected = len(split_lines(messages))
+    try:
+        acked = post_messages(path, messages, timeout)
+    except OSError as e:
+        sys.exit(f'Writer daemon is not available: {e}')
+    if acked < expected:
+        sys.exit(f'Only {acked} of {expected} messages were delivered')
+
+
+if __name__ == '__main__':
+    import configargparse
+
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--socket', type=str, required=True,
+        help='UNIX socket of the writer daemon', env_var='WRITER_DAEMON'
+    )
+    parser.add_argument(
+        '--message', type=str,
+        help='Message to send, lines from stdin without it'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=30.0,
+        help='Seconds to wait for the daemon'
+    )
+    args = parser.parse_args()
+
+    messages = [args.message] if args.message is not None else sys.stdin
+    post_or_exit(args.socket, [message.rstrip('\n') for message in messages],
+                 args.timeout)
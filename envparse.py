@@ -0,0 +1,31 @@
+import argparse
+import os
+
+# argparse with the env_var= argument of configargparse, for the writer:
+# configargparse cost its cold start more than the rest of the writer.
+
+
+class HelpFormatter(argparse.HelpFormatter):
+    # argparse loads shutil, and bz2 and lzma with it, only to ask for the
+    # terminal width
+    def __init__(self, prog):
+        try:
+            width = os.get_terminal_size().columns
+        except OSError:
+            width = 80
+        super().__init__(prog, width=width - 2)
+
+
+class ArgParser(argparse.ArgumentParser):
+    def __init__(self, **kwargs):
+        kwargs.setdefault('formatter_class', HelpFormatter)
+        super().__init__(**kwargs)
+
+    def add_argument(self, *args, env_var=None, **kwargs):
+        # a set variable becomes the default, argparse converts it with
+        # `type` like a value from the command line
+        if env_var:
+            if env_var in os.environ:
+                kwargs['default'] = os.environ[env_var]
+            kwargs['help'] = f'{kwargs.get("help", "")} [env var: {env_var}]'
+        return super().add_argument(*args, **kwargs)
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from enum import Enum
+
+import metrics
+
+
+class ReadConnectionStateChanged(Enum):
+    INITIATED = 'connecting'
+    ESTABLISHED = 'connection established'
+    IDLE = 'connection established, no messages lately'
+    CLOSED = 'connection closed'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class SendingConnectionStateChanged(Enum):
+    INITIATED = 'connecting'
+    ESTABLISHED = 'connection established'
+    CLOSED = 'connection closed'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class NicknameReceived:
+    def __init__(self, nickname):
+        self.nickname = nickname
+
+
+class ReconnectScheduled:
+    def __init__(self, connection, delay, circuit):
+        self.connection = connection
+        self.delay = delay
+        self.circuit = circuit
+
+    def __str__(self):
+        return f'reconnecting in {self.delay:.1f}s (circuit {self.circuit})'
+
+
+def status_text(event):
+    # the label an event changes and its new text
+    if isinstance(event, ReconnectScheduled):
+        if event.connection == 'read':
+            return 'read', f'Reading: {event}'
+        return 'send', f'Sending: {event}'
+    if isinstance(event, ReadConnectionStateChanged):
+        return 'read', f'Reading: {event}'
+    if isinstance(event, SendingConnectionStateChanged):
+        return 'send', f'Sending: {event}'
+    if isinstance(event, NicknameReceived):
+        return 'nickname', f'Username: {event.nickname}'
+    return type(event).__name__, str(event)
+
+
+class StatusState:
+    # What the status panel shows. Events are put into it the same way as
+    # into a queue, but it only keeps the current text of every label and
+    # wakes the panel up when one of them really changed. Live figures are
+    # read only when the panel repaints, so they cost nothing per message.
+
+    def __init__(self):
+        self.labels = {
+            'nickname': 'Username: unknown',
+            'read': 'Reading: no connection',
+            'send': 'Sending: no connection',
+        }
+        # name: (read, format, last value and time for rates)
+        self._live = {}
+        self._changed = asyncio.Event()
+
+        self._transitions = metrics.counter(
+            'chat_status_transitions_total', 'Status label changes')
+        self._repeated = metrics.counter(
+            'chat_status_repeated_total',
+            'Status updates that did not change anything')
+
+    def put_nowait(self, event):
+        label, text = status_text(event)
+        if self.labels.get(label) == text:
+            self._repeated.inc()
+            return
+        self.labels[label] = text
+        self._transitions.inc()
+        self._changed.set()
+
+    def watch(self, name, read, fmt):
+        # `fmt` gets the value, None values are not shown
+        self._live[name] = (read, fmt, None)
+
+    def watch_rate(self, name, read, fmt):
+        # shows how fast the value of `read` grows per second
+        self._live[name] = (read, fmt, (read(), time.monotonic()))
+
+    def live(self):
+        parts = []
+        for name, (read, fmt, last) in self._live.items():
+            value = read()
+            if last is not None:
+                now = time.monotonic()
+                last_value, last_time = last
+                self._live[name] = (read, fmt, (value, now))
+                value = (value - last_value) / max(now - last_time, 1e-9)
+            if value is not None:
+                parts.append(fmt.format(value))
+        return ', '.join(parts)
+
+    def snapshot(self):
+        return {**self.labels, 'live': self.live()}
+
+    async def changed(self, timeout):
+        # returns after a change or the timeout, whichever comes first
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
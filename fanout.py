@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from anyio import create_task_group
+
+from common import CHUNK_SIZE, MessageStamper, manage_socket
+from history import HistoryWriter
+from queues import BoundedQueue
+
+logger = logging.getLogger(__name__)
+
+_pattern = None
+_stamper = MessageStamper()
+
+
+def init_worker(pattern):
+    global _pattern
+    _pattern = re.compile(pattern) if pattern else None
+
+
+def format_batch(data, received_at):
+    # runs in a worker process: decodes, filters and timestamps a block of
+    # complete lines, all of them received at the same moment
+    return _stamper.stamp_lines(data.decode(errors='replace').split('\n'),
+                                _pattern, received_at)
+
+
+async def read_raw_batches(reader, pool, pending, chunk_size=CHUNK_SIZE):
+    # The reader only cuts the stream at the last newline of every chunk:
+    # b'\n' never occurs inside a multi-byte UTF-8 character, so nothing
+    # has to be decoded here. Once `pending` is full the socket is not read
+    # any more and the server is slowed down by TCP flow control.
+    loop = asyncio.get_running_loop()
+    tail = b''
+    while True:
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            data, tail = tail, b''
+        else:
+            data = tail + chunk
+            end = data.rfind(b'\n') + 1
+            if not end:
+                tail = data
+                continue
+            data, tail = data[:end], data[end:]
+        if data:
+            await pending.put(loop.run_in_executor(
+                pool, format_batch, data, time.time()))
+        if not chunk:
+            await pending.put(None)
+            return
+
+
+async def collect_batches(pending, history_queue):
+    # batches are awaited in the order they were read, whatever worker
+    # finishes first
+    while True:
+        future = await pending.get()
+        if future is None:
+            return
+        messages = await future
+        if not messages:
+            continue
+        print('\n'.join(messages))
+        # a full queue holds the batches back and the reader with them
+        await history_queue.put('\n'.join(messages))
+
+
+async def read_chat_fanout(host, port, history_queue, pool, max_pending):
+    pending = asyncio.Queue(maxsize=max_pending)
+    async with manage_socket(host, port) as (reader, _):
+        async with create_task_group() as tg:
+            tg.start_soon(read_raw_batches, reader, pool, pending)
+            tg.start_soon(collect_batches, pending, history_queue)
+
+
+async def display_chat_fanout(host, port, history, workers, max_pending=None,
+                              pattern=None, batch_size=64 * 1024,
+                              flush_interval=0.5, durability='flush',
+                              backend=None, index=None, queue_size=64):
+    history_queue = BoundedQueue(queue_size, 'block', 'history')
+    history_writer = HistoryWriter(history, history_queue, batch_size,
+                                   flush_interval, durability, backend, index)
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                               initargs=(pattern,))
+    logger.debug(f'Formatting the chat in {workers} worker processes')
+    try:
+        async with create_task_group() as tg:
+            tg.start_soon(history_writer.run)
+            await read_chat_fanout(host, port, history_queue, pool,
+                                   max_pending or workers * 2)
+            # the writer only stops when cancelled, as in main.display_chat
+            tg.cancel_scope.cancel()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
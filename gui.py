@@ -1,86 +1,211 @@
+import _tkinter
 import asyncio
+import time
 import tkinter as tk
-from enum import Enum
+from functools import partial
 from tkinter.scrolledtext import ScrolledText
 
 from anyio import create_task_group, ExceptionGroup
 
-
-class TkAppClosed(Exception):
-    pass
-
-
-class ReadConnectionStateChanged(Enum):
-    INITIATED = 'connecting'
-    ESTABLISHED = 'connection established'
-    CLOSED = 'connection closed'
-
-    def __str__(self):
-        return str(self.value)
+import metrics
+from history import HistoryPager
 
 
-class SendingConnectionStateChanged(Enum):
-    INITIATED = 'connecting'
-    ESTABLISHED = 'connection established'
-    CLOSED = 'connection closed'
+FRAME_INTERVAL = 1 / 120
+IDLE_INTERVAL = 1 / 20
+FRAME_BUDGET = 2000
+STATS_INTERVAL = 1.0
 
-    def __str__(self):
-        return str(self.value)
 
-
-class NicknameReceived:
-    def __init__(self, nickname):
-        self.nickname = nickname
+class TkAppClosed(Exception):
+    pass
 
 
 def process_new_message(input_field, sending_queue):
     text = input_field.get()
-    sending_queue.put_nowait(text)
+    if not text.strip():
+        # an empty message is two empty lines on the wire, the server
+        # answers both and the extra answer would confirm the next message
+        input_field.delete(0, tk.END)
+        return
+    try:
+        sending_queue.put_nowait(text)
+    except asyncio.QueueFull:
+        # the text stays in the field until there is room to send it
+        input_field.bell()
+        return
     input_field.delete(0, tk.END)
 
 
-async def update_tk(root_frame, interval=1 / 120):
+def process_tk_events(root_frame):
+    busy = False
+    while root_frame.tk.dooneevent(_tkinter.DONT_WAIT):
+        busy = True
+    # dooneevent keeps quiet after the window is destroyed, this does not
+    root_frame.winfo_exists()
+    return busy
+
+
+async def update_tk(root_frame, renderers=(), interval=FRAME_INTERVAL,
+                    idle_interval=IDLE_INTERVAL):
+    # poll at full frame rate only while there is something to do: user
+    # input, redraws or queued messages; back off while the app is idle
+    delay = interval
+    frame_time = metrics.histogram('gui_frame_seconds',
+                                   'Time to render a frame and handle events')
+    rendered_total = metrics.counter('gui_messages_rendered_total',
+                                     'Messages put on the screen')
     while True:
+        started = time.perf_counter()
         try:
-            root_frame.update()
+            rendered = sum(render() for render in renderers)
+            busy = process_tk_events(root_frame)
         except tk.TclError:
             # if application has been destroyed/closed
             raise TkAppClosed()
-        await asyncio.sleep(interval)
-
-
-async def update_conversation_history(panel, messages_queue):
-    while True:
-        msg = await messages_queue.get()
-
-        panel['state'] = 'normal'
-        if panel.index('end-1c') != '1.0':
-            panel.insert('end', '\n')
-        panel.insert('end', msg)
-        # TODO сделать промотку умной, чтобы не мешала просматривать историю сообщений
-        # ScrolledText.frame
-        # ScrolledText.vbar
+        frame_time.observe(time.perf_counter() - started)
+        rendered_total.inc(rendered)
+
+        if rendered or busy:
+            delay = interval
+        else:
+            delay = min(delay * 2, idle_interval)
+        await asyncio.sleep(delay)
+
+
+def line_number(panel, index):
+    return int(panel.index(index).split('.')[0])
+
+
+def trim_scrollback(panel, scrollback, following, on_trim=None):
+    excess = line_number(panel, 'end-1c') - scrollback
+    # trim in batches so the delete stays rare; while the user reads older
+    # messages the panel may grow up to twice the cap before it is trimmed
+    if excess < max(scrollback // 10, 1):
+        return
+    if not following and excess < scrollback:
+        return
+
+    top = line_number(panel, '@0,0')
+    panel.delete('1.0', f'{excess + 1}.0')
+    if on_trim:
+        on_trim(excess)
+    if not following:
+        panel.yview(f'{max(top - excess, 1)}.0')
+
+
+def render_conversation(panel, messages_queue, budget=FRAME_BUDGET,
+                        scrollback=None, on_trim=None):
+    # called once per frame: everything queued since the previous frame
+    # (up to the budget) goes to the panel in a single insert
+    msgs = []
+    while len(msgs) < budget:
+        try:
+            msgs.append(messages_queue.get_nowait())
+        except asyncio.QueueEmpty:
+            break
+    if not msgs:
+        return 0
+
+    # scroll along with new messages only if the user has not scrolled up
+    following = panel.yview()[1] >= 1.0
+
+    panel['state'] = 'normal'
+    if panel.index('end-1c') != '1.0':
+        msgs.insert(0, '')
+    panel.insert('end', '\n'.join(msgs))
+    if scrollback:
+        trim_scrollback(panel, scrollback, following, on_trim)
+    if following:
         panel.yview(tk.END)
-        panel['state'] = 'disabled'
-
-
-async def update_status_panel(status_labels, status_updates_queue):
-    nickname_label, read_label, write_label = status_labels
-
-    read_label['text'] = f'Reading: no connection'
-    write_label['text'] = f'Sending: no connection'
-    nickname_label['text'] = f'Username: unknown'
-
+    panel['state'] = 'disabled'
+    return len(msgs)
+
+
+def prepend_history(panel, lines):
+    panel['state'] = 'normal'
+    if panel.index('end-1c') != '1.0':
+        lines.append('')
+    panel.insert('1.0', '\n'.join(lines))
+    panel['state'] = 'disabled'
+    # keep the line that was on top in place so the user keeps reading
+    panel.yview(f'{len(lines)}.0')
+
+
+def watch_history_scroll(panel, load_older):
+    def on_scroll(first, last):
+        panel.vbar.set(first, last)
+        if float(first) == 0:
+            lines = load_older()
+            if lines:
+                prepend_history(panel, lines)
+
+    panel['yscrollcommand'] = on_scroll
+
+
+def show_search_results(root_frame, results, history_pager):
+    window = tk.Toplevel(root_frame)
+    window.title(f'Search: {len(results)} found')
+
+    results_list = tk.Listbox(window, height=10)
+    results_list.pack(side="top", fill=tk.X)
+    for _, text in results:
+        results_list.insert(tk.END, text)
+
+    context_panel = ScrolledText(window, wrap='none', height=20)
+    context_panel.pack(side="top", fill="both", expand=True)
+    context_panel.tag_configure('found', background='yellow')
+    context_panel['state'] = 'disabled'
+    # every window pages through the history on its own
+    pager = HistoryPager(history_pager.store, history_pager.page_size)
+    watch_history_scroll(context_panel, pager.older)
+
+    def on_select(event):
+        selection = results_list.curselection()
+        if not selection:
+            return
+        lines, found = pager.around(results[selection[0]][0])
+        context_panel['state'] = 'normal'
+        context_panel.delete('1.0', tk.END)
+        context_panel.insert('1.0', '\n'.join(lines))
+        context_panel.tag_add('found', f'{found + 1}.0', f'{found + 1}.end')
+        context_panel['state'] = 'disabled'
+        context_panel.see(f'{found + 1}.0')
+
+    results_list.bind('<<ListboxSelect>>', on_select)
+
+
+def create_search_panel(root_frame, search, history_pager):
+    search_frame = tk.Frame(root_frame)
+    search_frame.pack(side="top", fill=tk.X)
+
+    search_field = tk.Entry(search_frame)
+    search_field.pack(side="left", fill=tk.X, expand=True)
+
+    def run_search(event=None):
+        query = search_field.get().strip()
+        if query:
+            show_search_results(root_frame, search(query), history_pager)
+
+    search_field.bind("<Return>", run_search)
+
+    search_button = tk.Button(search_frame)
+    search_button["text"] = "Search"
+    search_button["command"] = run_search
+    search_button.pack(side="left")
+
+
+async def update_status_panel(status_labels, status_state):
+    # repaints only the labels whose text changed, bursts of changes at
+    # most once a frame and the live figures once a STATS_INTERVAL
+    shown = {}
     while True:
-        msg = await status_updates_queue.get()
-        if isinstance(msg, ReadConnectionStateChanged):
-            read_label['text'] = f'Reading: {msg}'
-
-        if isinstance(msg, SendingConnectionStateChanged):
-            write_label['text'] = f'Sending: {msg}'
-
-        if isinstance(msg, NicknameReceived):
-            nickname_label['text'] = f'Username: {msg.nickname}'
+        for name, text in status_state.snapshot().items():
+            if shown.get(name) != text:
+                status_labels[name]['text'] = text
+                shown[name] = text
+        await status_state.changed(STATS_INTERVAL)
+        await asyncio.sleep(FRAME_INTERVAL)
 
 
 def create_status_panel(root_frame):
@@ -99,10 +224,19 @@ def create_status_panel(root_frame):
     status_write_label = tk.Label(connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
     status_write_label.pack(side="top", fill=tk.X)
 
-    return (nickname_label, status_read_label, status_write_label)
+    live_label = tk.Label(connections_frame, height=1, fg='grey', font='arial 10', anchor='w')
+    live_label.pack(side="top", fill=tk.X)
+
+    return {
+        'nickname': nickname_label,
+        'read': status_read_label,
+        'send': status_write_label,
+        'live': live_label,
+    }
 
 
-async def draw(messages_queue, sending_queue, status_updates_queue):
+async def draw(messages_queue, sending_queue, status_state,
+               history_pager=None, scrollback=None, search=None):
     root = tk.Tk()
 
     root.title('Chat')
@@ -112,6 +246,9 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
 
     status_labels = create_status_panel(root_frame)
 
+    if search and history_pager:
+        create_search_panel(root_frame, search, history_pager)
+
     input_frame = tk.Frame(root_frame)
     input_frame.pack(side="bottom", fill=tk.X)
 
@@ -127,11 +264,18 @@ async def draw(messages_queue, sending_queue, status_updates_queue):
 
     conversation_panel = ScrolledText(root_frame, wrap='none')
     conversation_panel.pack(side="top", fill="both", expand=True)
-    
+    on_trim = None
+    if history_pager:
+        watch_history_scroll(conversation_panel, history_pager.older)
+        on_trim = history_pager.skip
+
     try:
         async with create_task_group() as tg:
-            tg.start_soon(update_tk, root_frame)
-            tg.start_soon(update_conversation_history, conversation_panel, messages_queue)
-            tg.start_soon(update_status_panel, status_labels, status_updates_queue)
+            tg.start_soon(update_tk, root_frame, [
+                partial(render_conversation, conversation_panel,
+                        messages_queue, scrollback=scrollback,
+                        on_trim=on_trim)
+            ])
+            tg.start_soon(update_status_panel, status_labels, status_state)
     except ExceptionGroup:
         pass
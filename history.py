@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import mmap
+import os
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_MODES = ('none', 'flush', 'fsync')
+
+
+class TextHistory:
+    # the plain text format: one formatted message per line
+
+    def __init__(self, path, durability='flush'):
+        self.path = path
+        self.durability = durability
+        self._file = None
+
+    def write(self, messages):
+        if self._file is None:
+            self._file = open(self.path, mode='a')
+        messages.append('')
+        self._file.write('\n'.join(messages))
+        if self.durability in ('flush', 'fsync'):
+            self._file.flush()
+        if self.durability == 'fsync':
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            if self.durability == 'fsync':
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+class HistoryWriter:
+    def __init__(self, path, queue, batch_size=64 * 1024, flush_interval=0.5,
+                 durability='flush', backend=None, index=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability mode: {durability}')
+        self.path = path
+        self.queue = queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.backend = backend or TextHistory(path, durability)
+        self.index = index
+
+        self._buffer = []
+        self._buffered = 0
+        self._written = metrics.counter(
+            'history_messages_written_total', 'Messages written to history')
+        self._write_latency = metrics.histogram(
+            'history_write_seconds', 'Time to write a history batch')
+        self._index_latency = metrics.histogram(
+            'history_index_seconds', 'Time to index a history batch')
+        # a single worker keeps batches in order and lets close() wait for
+        # a write that is still in flight when the task gets cancelled
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _append(self, message):
+        self._buffer.append(message)
+        self._buffered += len(message) + 1
+
+    def _drain_queue(self, limit=None):
+        while limit is None or self._buffered < limit:
+            try:
+                self._append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+    def _take_batch(self):
+        # a queued item is one history line or a block of them joined with
+        # newlines
+        batch = self._buffer
+        self._buffer = []
+        self._buffered = 0
+        return batch
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        self._append(await self.queue.get())
+        deadline = loop.time() + self.flush_interval
+
+        while True:
+            self._drain_queue(self.batch_size)
+            timeout = deadline - loop.time()
+            if self._buffered >= self.batch_size or timeout <= 0:
+                return
+            try:
+                self._append(
+                    await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                return
+
+    async def run(self):
+        try:
+            if self.index:
+                # catch up with what was written while nobody indexed it
+                await asyncio.wrap_future(
+                    self._executor.submit(self.index.update))
+            while True:
+                await self._collect_batch()
+                batch = self._take_batch()
+                await asyncio.wrap_future(
+                    self._executor.submit(self._write_batch, batch))
+        finally:
+            self.close()
+
+    def _write_batch(self, batch):
+        self._written.inc(sum(item.count('\n') + 1 for item in batch))
+        with self._write_latency.time():
+            self.backend.write(batch)
+        if self.index:
+            with self._index_latency.time():
+                self.index.update()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._drain_queue()
+        if self._buffer:
+            self._write_batch(self._take_batch())
+        self.backend.close()
+        if self.index:
+            self.index.close()
+        logger.debug(f'History writer closed: {self.path}')
+
+
+class HistoryStore:
+    # Random access to a history file: the file is memory-mapped and a
+    # sidecar index (<path>.idx) keeps the start offset of every complete
+    # line plus the end of the indexed part. Only data appended since the
+    # last run has to be scanned to bring the index up to date.
+
+    def __init__(self, path, chunk_size=4 * 1024 * 1024):
+        self.path = path
+        self.index_path = f'{path}.idx'
+        self.chunk_size = chunk_size
+        self.offsets = array('Q', [0])
+        self._file = None
+        self._map = None
+        self.size = 0
+        self.refresh()
+
+    def refresh(self):
+        self._close_map()
+        try:
+            self._file = open(self.path, mode='rb')
+        except FileNotFoundError:
+            logger.error(f'File not found: {self.path}')
+            self.size = 0
+            return
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size:
+            self._map = mmap.mmap(self._file.fileno(), self.size,
+                                  access=mmap.ACCESS_READ)
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self._close_map()
+
+    def _load_index(self):
+        offsets = array('Q')
+        try:
+            with open(self.index_path, mode='rb') as f:
+                offsets.frombytes(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        if not offsets or offsets[0] != 0 or offsets[-1] > self.size:
+            # the history was truncated or replaced, start from scratch
+            return None
+        return offsets
+
+    def update_index(self):
+        # blocking, meant to be run in a worker thread; readers keep using
+        # the previous index until the new one is swapped in
+        if self._file is None:
+            return 0
+        offsets = self._load_index()
+        rebuild = offsets is None
+        if rebuild:
+            offsets = array('Q', [0])
+        indexed = len(offsets)
+
+        position = offsets[-1]
+        with open(self.path, mode='rb') as f:
+            f.seek(position)
+            tail = b''
+            while position < self.size:
+                chunk = tail + f.read(min(self.chunk_size,
+                                          self.size - position))
+                lines = chunk.split(b'\n')
+                tail = lines.pop()
+                start = offsets[-1]
+                offsets.extend(accumulate(
+                    map((1).__add__, map(len, lines)), initial=start))
+                del offsets[-len(lines) - 1]
+                position = start + len(chunk)
+
+        new_offsets = offsets if rebuild else offsets[indexed:]
+        with open(self.index_path, mode='wb' if rebuild else 'ab') as f:
+            f.write(new_offsets.tobytes())
+
+        self.offsets = offsets
+        logger.debug(f'History index updated: {len(offsets) - 1} lines')
+        return len(offsets) - 1
+
+    def _decode(self, start, end):
+        lines = self._map[start:end].decode(errors='replace').split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        return lines
+
+    def read_before(self, offset, count):
+        # returns up to `count` lines ending right before `offset` and the
+        # offset the returned block starts at
+        if self._map is None or offset <= 0 or count <= 0:
+            return 0, []
+
+        end = offset
+        if self._map[end - 1:end] == b'\n':
+            end -= 1
+
+        line = bisect_left(self.offsets, offset)
+        if line < len(self.offsets) and self.offsets[line] == offset:
+            start = self.offsets[max(line - count, 0)]
+        else:
+            newline = end
+            for _ in range(count):
+                newline = self._map.rfind(b'\n', 0, newline)
+                if newline < 0:
+                    break
+            start = newline + 1
+
+        return start, self._decode(start, offset)
+
+    def read_after(self, offset, count):
+        # up to `count` lines starting at `offset` and the offset after them
+        if self._map is None or offset >= self.size:
+            return offset, []
+        end = self.skip_lines(offset, count)
+        return end, self._decode(offset, end)
+
+    def tail(self, count):
+        return self.read_before(self.size, count)
+
+    def skip_lines(self, offset, count):
+        # offset of the line `count` lines after the one at `offset`
+        line = bisect_left(self.offsets, offset)
+        if line < len(self.offsets) and self.offsets[line] == offset:
+            ahead = min(count, len(self.offsets) - 1 - line)
+            offset = self.offsets[line + ahead]
+            count -= ahead
+
+        while count and offset < self.size:
+            newline = self._map.find(b'\n', offset)
+            if newline < 0:
+                break
+            offset = newline + 1
+            count -= 1
+        return offset
+
+
+class HistoryPager:
+    def __init__(self, store, page_size):
+        self.store = store
+        self.page_size = page_size
+        self.offset = None
+
+    def tail(self):
+        self.offset, lines = self.store.tail(self.page_size)
+        return lines
+
+    def skip(self, count):
+        # the oldest `count` shown lines were dropped from the screen, so
+        # the next page has to start right after them
+        if self.offset is None:
+            return
+        self.store.refresh()
+        self.offset = self.store.skip_lines(self.offset, count)
+
+    def around(self, offset):
+        # a page with the line at `offset` in the middle and the position
+        # of that line in it; older pages can be loaded from there
+        self.store.refresh()
+        self.offset, before = self.store.read_before(offset,
+                                                     self.page_size // 2)
+        _, after = self.store.read_after(offset,
+                                         self.page_size - len(before))
+        return before + after, len(before)
+
+    def older(self):
+        if not self.offset:
+            return []
+        self.offset, lines = self.store.read_before(self.offset,
+                                                    self.page_size)
+        return lines
@@ -0,0 +1,494 @@
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import struct
+import sys
+import time
+from array import array
+
+from common import TIMESTAMP_FORMAT
+from history import DURABILITY_MODES, HistoryStore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FORMATS = ('text', 'records')
+COMPRESSION_MODES = ('gzip', 'zstd', 'none')
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+# every record: timestamp in seconds, payload length, UTF-8 payload
+HEADER = struct.Struct('<qI')
+# "[dd.mm.yy HH.MM] " put in front of every message by the readers
+PREFIX_LENGTH = 17
+
+
+def split_timestamp(line, _cache={}):
+    # messages arrive formatted, the prefix is turned back into a number;
+    # lines without one are kept as they are with a zero timestamp
+    if line[:1] != '[' or line[15:17] != '] ':
+        return 0, line
+    prefix = line[1:15]
+    timestamp = _cache.get(prefix)
+    if timestamp is None:
+        try:
+            timestamp = int(datetime.datetime.strptime(
+                prefix, TIMESTAMP_FORMAT).timestamp())
+        except ValueError:
+            return 0, line
+        if len(_cache) > 1024:
+            _cache.clear()
+        _cache[prefix] = timestamp
+    return timestamp, line[PREFIX_LENGTH:]
+
+
+def format_record(timestamp, payload):
+    if not timestamp:
+        return payload
+    stamp = datetime.datetime.fromtimestamp(timestamp).strftime(
+        TIMESTAMP_FORMAT)
+    return f'[{stamp}] {payload}'
+
+
+def scan_records(data, offsets=None, start=0):
+    # offsets of the complete records in `data` from `start` on and the end
+    # of the last one
+    if offsets is None:
+        offsets = array('Q')
+    position = start
+    while position + HEADER.size <= len(data):
+        _, length = HEADER.unpack_from(data, position)
+        end = position + HEADER.size + length
+        if end > len(data):
+            break
+        offsets.append(position)
+        position = end
+    return offsets, position
+
+
+def decode_records(data, start=0, end=None):
+    end = len(data) if end is None else end
+    records = []
+    position = start
+    while position < end:
+        timestamp, length = HEADER.unpack_from(data, position)
+        position += HEADER.size
+        records.append(format_record(
+            timestamp,
+            bytes(data[position:position + length]).decode(errors='replace')
+        ))
+        position += length
+    return records
+
+
+def compress(path, compression):
+    target = path + SUFFIXES[compression]
+    if compression == 'none':
+        return target
+    with open(path, 'rb') as src, open(target + '.tmp', 'wb') as dst:
+        if compression == 'gzip':
+            with gzip.GzipFile(fileobj=dst, mode='wb', compresslevel=6) as f:
+                while chunk := src.read(1024 * 1024):
+                    f.write(chunk)
+        else:
+            zstandard.ZstdCompressor().copy_stream(src, dst)
+    os.replace(target + '.tmp', target)
+    os.remove(path)
+    return target
+
+
+def open_segment(path):
+    # a binary file object, decompressed as the suffix says
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f'zstandard is needed to read {path}')
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),
+                                                          closefd=True)
+    return open(path, 'rb')
+
+
+def read_segment(path):
+    with open_segment(path) as f:
+        return f.read()
+
+
+def stream_records(path, chunk_size=1024 * 1024):
+    # (timestamp, payload) of every complete record of a segment, read in
+    # chunks so that memory does not grow with the file
+    with open_segment(path) as f:
+        data = b''
+        while chunk := f.read(chunk_size):
+            data += chunk
+            position = 0
+            while position + HEADER.size <= len(data):
+                timestamp, length = HEADER.unpack_from(data, position)
+                end = position + HEADER.size + length
+                if end > len(data):
+                    break
+                yield timestamp, data[position + HEADER.size:end].decode(
+                    errors='replace')
+                position = end
+            data = data[position:]
+
+
+def segment_paths(path):
+    # the files of a records history, oldest first, the active one last
+    paths = [os.path.join(os.path.dirname(path), segment['name'])
+             for segment in load_manifest(path)]
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def load_manifest(path):
+    # closed segments in order, one JSON object per line
+    segments = []
+    try:
+        with open(f'{path}.segments') as f:
+            for line in f:
+                if line.strip():
+                    segments.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+    return segments
+
+
+class RecordHistory:
+    # Compact history: `path` is the active segment of binary records, a
+    # full segment is renamed to <path>.<number>, compressed and listed in
+    # <path>.segments with its record count and time range, so readers
+    # never have to open it to find a record.
+
+    def __init__(self, path, durability='flush', rotate_size=16 * 1024 * 1024,
+                 rotate_interval=None, compression='gzip'):
+        if compression not in COMPRESSION_MODES:
+            raise ValueError(f'Unknown compression: {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        self.path = path
+        self.durability = durability
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.compression = compression
+
+        self._file = None
+        self._size = 0
+        self._records = 0
+        self._first = None
+        self._last = None
+
+    def _open(self):
+        self._finish_rotations()
+        self._file = open(self.path, mode='a+b')
+        self._file.seek(0)
+        data = self._file.read()
+        offsets, end = scan_records(data)
+        if end < len(data):
+            # the tail of a record cut by a crash
+            logger.warning(f'Dropping {len(data) - end} broken bytes from '
+                           f'{self.path}')
+            self._file.truncate(end)
+        self._size = end
+        self._records = len(offsets)
+        self._first = self._last = None
+        if offsets:
+            self._first = HEADER.unpack_from(data, 0)[0]
+            self._last = HEADER.unpack_from(data, offsets[-1])[0]
+
+    def _finish_rotations(self):
+        # segments renamed but not compressed when the process stopped
+        segments = load_manifest(self.path)
+        listed = {segment['name'] for segment in segments}
+        suffix = SUFFIXES[self.compression]
+        for raw in sorted(glob.glob(f'{glob.escape(self.path)}.[0-9]*')):
+            if not raw[len(self.path) + 1:].isdigit() or \
+                    os.path.basename(raw + suffix) in listed:
+                continue
+            data = read_segment(raw)
+            offsets, _ = scan_records(data)
+            self._close_segment(raw, data, offsets)
+
+    def _close_segment(self, raw, data, offsets):
+        first = HEADER.unpack_from(data, 0)[0] if offsets else None
+        last = HEADER.unpack_from(data, offsets[-1])[0] if offsets else None
+        target = compress(raw, self.compression)
+        with open(f'{self.path}.segments', mode='a') as f:
+            f.write(json.dumps({
+                'name': os.path.basename(target),
+                'records': len(offsets),
+                'bytes': len(data),
+                'first': first,
+                'last': last,
+            }) + '\n')
+        logger.debug(f'History segment closed: {target}')
+
+    def rotate(self):
+        if self._file is None:
+            self._open()
+        if not self._records:
+            return
+        self._file.close()
+        self._file = None
+        number = len(load_manifest(self.path)) + 1
+        raw = f'{self.path}.{number:06d}'
+        os.replace(self.path, raw)
+        with open(raw, 'rb') as f:
+            data = f.read()
+        self._close_segment(raw, data, scan_records(data)[0])
+        self._open()
+
+    def _should_rotate(self):
+        if self.rotate_size and self._size >= self.rotate_size:
+            return True
+        return bool(self.rotate_interval and self._first and
+                    time.time() - self._first >= self.rotate_interval)
+
+    def write(self, messages):
+        if self._file is None:
+            self._open()
+        data = bytearray()
+        now = int(time.time())
+        for message in messages:
+            for line in message.split('\n'):
+                timestamp, payload = split_timestamp(line)
+                payload = payload.encode()
+                data += HEADER.pack(timestamp, len(payload))
+                data += payload
+                self._records += 1
+                if self._first is None:
+                    self._first = timestamp or now
+                self._last = timestamp or now
+        self._file.write(data)
+        self._size += len(data)
+        if self.durability in ('flush', 'fsync'):
+            self._file.flush()
+        if self.durability == 'fsync':
+            os.fsync(self._file.fileno())
+        if self._should_rotate():
+            self.rotate()
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            if self.durability == 'fsync':
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+class RecordStore:
+    # HistoryStore for the records format. Offsets are record numbers over
+    # all segments, which is all HistoryPager needs.
+
+    def __init__(self, path, cached_segments=2):
+        self.path = path
+        self.cached_segments = cached_segments
+        self.segments = []
+        self.starts = [0]
+        self.offsets = array('Q')
+        self._active = bytearray()
+        self._scanned = 0
+        self._cache = {}
+        self.size = 0
+        self.refresh()
+
+    def refresh(self):
+        segments = load_manifest(self.path)
+        if len(segments) != len(self.segments):
+            self.segments = segments
+            self.starts = [0]
+            for segment in segments:
+                self.starts.append(self.starts[-1] + segment['records'])
+            # the old active segment was rotated away
+            self._reset_active()
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < len(self._active):
+                    self._reset_active()
+                # only what was appended since the last refresh is read
+                f.seek(len(self._active))
+                self._active += f.read()
+        except FileNotFoundError:
+            self._reset_active()
+        _, self._scanned = scan_records(self._active, self.offsets,
+                                        self._scanned)
+        self.size = self.starts[-1] + len(self.offsets)
+
+    def _reset_active(self):
+        self._active = bytearray()
+        self.offsets = array('Q')
+        self._scanned = 0
+
+    def update_index(self):
+        return self.size
+
+    def close(self):
+        self._reset_active()
+        self._cache.clear()
+
+    def _segment(self, number):
+        if number not in self._cache:
+            if len(self._cache) >= self.cached_segments:
+                self._cache.pop(next(iter(self._cache)))
+            path = os.path.join(os.path.dirname(self.path),
+                                self.segments[number]['name'])
+            data = read_segment(path)
+            offsets, end = scan_records(data)
+            offsets.append(end)
+            self._cache[number] = data, offsets
+        return self._cache[number]
+
+    def read_range(self, start, end):
+        lines = []
+        for number, segment_start in enumerate(self.starts[:-1]):
+            segment_end = self.starts[number + 1]
+            if segment_end <= start or segment_start >= end:
+                continue
+            data, offsets = self._segment(number)
+            lines.extend(decode_records(
+                data, offsets[max(start - segment_start, 0)],
+                offsets[min(end, segment_end) - segment_start]))
+        closed = self.starts[-1]
+        if end > closed:
+            first = max(start, closed) - closed
+            last = end - closed
+            lines.extend(decode_records(
+                self._active, self.offsets[first],
+                self.offsets[last] if last < len(self.offsets)
+                else self._scanned))
+        return lines
+
+    def read_before(self, offset, count):
+        if offset <= 0 or count <= 0:
+            return 0, []
+        start = max(offset - count, 0)
+        return start, self.read_range(start, offset)
+
+    def read_after(self, offset, count):
+        end = min(offset + count, self.size)
+        return end, self.read_range(offset, end)
+
+    def tail(self, count):
+        return self.read_before(self.size, count)
+
+    def skip_lines(self, offset, count):
+        return min(offset + count, self.size)
+
+
+def iter_history(path):
+    # every line of a records history, oldest first
+    store = RecordStore(path, cached_segments=1)
+    for number in range(len(store.segments)):
+        yield from decode_records(store._segment(number)[0])
+    yield from decode_records(store._active, 0, store._scanned)
+
+
+def make_history_backend(path, durability, history_format, rotate_size,
+                         rotate_interval, compression):
+    if history_format == 'text':
+        return None
+    return RecordHistory(path, durability, rotate_size, rotate_interval,
+                         compression)
+
+
+def make_history_store(path, history_format):
+    if history_format == 'text':
+        return HistoryStore(path)
+    return RecordStore(path)
+
+
+def add_history_arguments(parser):
+    # the history options of the chat readers, main.py and main_gui.py
+    parser.add_argument(
+        '--history', type=str, default='./log.txt',
+        help='Path to the log file', env_var='HISTORY_PATH'
+    )
+    parser.add_argument(
+        '--history_batch_size', type=int, default=64 * 1024,
+        help='Max size of a history write batch in characters',
+        env_var='HISTORY_BATCH_SIZE'
+    )
+    parser.add_argument(
+        '--history_flush_interval', type=float, default=0.5,
+        help='Max seconds a message waits before being written to history',
+        env_var='HISTORY_FLUSH_INTERVAL'
+    )
+    parser.add_argument(
+        '--history_durability', type=str, default='flush',
+        choices=DURABILITY_MODES,
+        help='What to do after each history batch: none, flush or fsync',
+        env_var='HISTORY_DURABILITY'
+    )
+    parser.add_argument(
+        '--history_format', type=str, default='text',
+        choices=HISTORY_FORMATS,
+        help='text lines or compact records rotated into compressed '
+             'segments', env_var='HISTORY_FORMAT'
+    )
+    parser.add_argument(
+        '--history_rotate_size', type=int, default=16 * 1024 * 1024,
+        help='Close a records segment once it is this many bytes',
+        env_var='HISTORY_ROTATE_SIZE'
+    )
+    parser.add_argument(
+        '--history_rotate_interval', type=float,
+        help='Close a records segment once it is this many seconds old',
+        env_var='HISTORY_ROTATE_INTERVAL'
+    )
+    parser.add_argument(
+        '--history_compression', type=str, default='gzip',
+        choices=COMPRESSION_MODES,
+        help='Compression of closed records segments',
+        env_var='HISTORY_COMPRESSION'
+    )
+    parser.add_argument(
+        '--history_search', action='store_true',
+        help='Keep a full-text search index of the history in <history>.fts',
+        env_var='HISTORY_SEARCH'
+    )
+
+
+def export_text(path, output):
+    exported = 0
+    out = sys.stdout if output == '-' else open(output, 'w')
+    try:
+        for line in iter_history(path):
+            out.write(line + '\n')
+            exported += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return exported
+
+
+if __name__ == '__main__':
+    import configargparse
+
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--history', type=str, default='./log.rec',
+        help='Path to the records history', env_var='HISTORY_PATH'
+    )
+    parser.add_argument(
+        '--output', type=str, default='-',
+        help='Text file to export the history to, - for stdout'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format=(
+            '%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s] '
+            '%(message)s'
+        ),
+        level=logging.INFO
+    )
+
+    logger.info(f'Exported {export_text(args.history, args.output)} lines')
@@ -0,0 +1,245 @@
+import asyncio
+import io
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from history_records import (HISTORY_FORMATS, open_segment, segment_paths,
+                             split_timestamp, stream_records)
+
+logger = logging.getLogger(__name__)
+
+
+def history_files(paths, history_format):
+    # a records history is made of its rotated segments and the active file,
+    # a single segment or a text file stands for itself
+    files = []
+    for path in paths:
+        segments = history_format == 'records' and segment_paths(path)
+        files.extend(segments or [path])
+    return files
+
+
+def stream_text(path):
+    with open_segment(path) as f:
+        for line in io.TextIOWrapper(f, errors='replace'):
+            line = line.rstrip('\n')
+            if line:
+                yield split_timestamp(line)
+
+
+def stream_history(path, history_format):
+    # (timestamp, payload) pairs of one file, 0 for lines without a time
+    if history_format == 'records':
+        return stream_records(path)
+    return stream_text(path)
+
+
+class HistoryStats:
+    # Aggregates that only grow with the number of users and days, never
+    # with the number of messages, and can be merged across files.
+
+    def __init__(self):
+        self.messages = 0
+        self.without_nickname = 0
+        self.users = Counter()
+        self.hours = [0] * 24
+        self.days = Counter()
+        self.first = None
+        self.last = None
+
+    def add(self, records):
+        # timestamps have minute resolution, every minute is split into a
+        # day and an hour only once
+        minutes = {}
+        for timestamp, payload in records:
+            self.messages += 1
+            nickname, separator, _ = payload.partition(': ')
+            if separator:
+                self.users[nickname] += 1
+            else:
+                self.without_nickname += 1
+            if not timestamp:
+                continue
+            when = minutes.get(timestamp)
+            if when is None:
+                if len(minutes) > 4096:
+                    minutes.clear()
+                local = time.localtime(timestamp)
+                when = minutes[timestamp] = (
+                    time.strftime('%Y-%m-%d', local), local.tm_hour)
+            self.days[when[0]] += 1
+            self.hours[when[1]] += 1
+            if self.first is None or timestamp < self.first:
+                self.first = timestamp
+            if self.last is None or timestamp > self.last:
+                self.last = timestamp
+        return self
+
+    def merge(self, other):
+        self.messages += other.messages
+        self.without_nickname += other.without_nickname
+        self.users.update(other.users)
+        self.hours = [a + b for a, b in zip(self.hours, other.hours)]
+        self.days.update(other.days)
+        for timestamp in (other.first, other.last):
+            if timestamp is None:
+                continue
+            self.first = min(self.first or timestamp, timestamp)
+            self.last = max(self.last or timestamp, timestamp)
+        return self
+
+    def as_dict(self, top):
+        return {
+            'messages': self.messages,
+            'without_nickname': self.without_nickname,
+            'users': len(self.users),
+            'first': self.first,
+            'last': self.last,
+            'top_talkers': self.users.most_common(top),
+            'by_hour': self.hours,
+            'by_day': dict(sorted(self.days.items())),
+        }
+
+
+def file_stats(path, history_format):
+    # runs in a worker process with --workers
+    return HistoryStats().add(stream_history(path, history_format))
+
+
+def collect_stats(files, history_format, workers=0):
+    stats = HistoryStats()
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            for file_result in pool.map(file_stats, files,
+                                        [history_format] * len(files)):
+                stats.merge(file_result)
+    else:
+        for path in files:
+            stats.merge(file_stats(path, history_format))
+    return stats
+
+
+def print_stats(stats, top, width=50):
+    def when(timestamp):
+        if timestamp is None:
+            return '-'
+        return time.strftime('%d.%m.%y %H.%M', time.localtime(timestamp))
+
+    print(f'Messages: {stats.messages} from {len(stats.users)} users, '
+          f'{stats.without_nickname} without a nickname')
+    print(f'From {when(stats.first)} to {when(stats.last)}')
+    print(f'\nTop {top} talkers:')
+    for nickname, count in stats.users.most_common(top):
+        print(f'{count:>10}  {nickname}')
+    print('\nBy hour:')
+    busiest = max(stats.hours) or 1
+    for hour, count in enumerate(stats.hours):
+        print(f'{hour:>4}  {"#" * (count * width // busiest):<{width}} '
+              f'{count}')
+
+
+def iter_replay(files, history_format):
+    for path in files:
+        yield from stream_history(path, history_format)
+
+
+async def replay(files, history_format, host, port, writer_port, speed,
+                 readers=0):
+    from mock_server import MockChatServer
+
+    server = MockChatServer()
+    port, writer_port = await server.start(host, port, writer_port)
+    logger.info(f'Listening on {host}:{port} (reader) and '
+                f'{host}:{writer_port} (writer)')
+    try:
+        while len(server.readers) < readers:
+            await asyncio.sleep(0.1)
+        started = time.monotonic()
+        sent = await server.replay(iter_replay(files, history_format), speed)
+        logger.info(f'Replayed {sent} messages in '
+                    f'{time.monotonic() - started:.1f}s')
+    finally:
+        await server.close()
+
+
+def parse_args():
+    import configargparse
+
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        'paths', type=str, nargs='+',
+        help='History files, a records history stands for all its segments'
+    )
+    parser.add_argument(
+        '--history_format', type=str, default='text',
+        choices=HISTORY_FORMATS, help='Format of the history',
+        env_var='HISTORY_FORMAT'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    stats_parser = subparsers.add_parser(
+        'stats', help='Count messages per user, hour and day')
+    stats_parser.add_argument(
+        '--top', type=int, default=10, help='Number of top talkers shown'
+    )
+    stats_parser.add_argument(
+        '--workers', type=int, default=0,
+        help='Read that many files at once in separate processes'
+    )
+    stats_parser.add_argument(
+        '--json', action='store_true', help='Print the stats as JSON'
+    )
+    replay_parser = subparsers.add_parser(
+        'replay', help='Broadcast the history from a mock chat server')
+    replay_parser.add_argument(
+        '--host', type=str, default='127.0.0.1', help='Address to listen on'
+    )
+    replay_parser.add_argument(
+        '--port', type=int, default=5000, help='Reader port'
+    )
+    replay_parser.add_argument(
+        '--writer_port', type=int, default=5050, help='Writer port'
+    )
+    replay_parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='Speed multiplier of the original pace, 0 for as fast as the '
+             'readers take it'
+    )
+    replay_parser.add_argument(
+        '--readers', type=int, default=1,
+        help='Wait for this many readers before replaying'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig(
+        format=(
+            '%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s] '
+            '%(message)s'
+        ),
+        level=logging.INFO
+    )
+
+    files = history_files(args.paths, args.history_format)
+    if args.command == 'stats':
+        started = time.monotonic()
+        stats = collect_stats(files, args.history_format, args.workers)
+        logger.info(f'{len(files)} files read in '
+                    f'{time.monotonic() - started:.2f}s')
+        if args.json:
+            import json
+            print(json.dumps(stats.as_dict(args.top), ensure_ascii=False,
+                             indent=2))
+        else:
+            print_stats(stats, args.top)
+    else:
+        try:
+            asyncio.run(replay(files, args.history_format, args.host,
+                               args.port, args.writer_port, args.speed,
+                               args.readers))
+        except KeyboardInterrupt:
+            logger.info('Replay stopped with CTRL+C')
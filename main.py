@@ -1,29 +1,44 @@
 import asyncio
-import datetime
+import re
 
-import aiofiles
 import configargparse
+from anyio import create_task_group
 
-from common import manage_socket
+import metrics
+from common import MessageStamper, open_session
+from history import HistoryWriter
+from history_records import add_history_arguments, make_history_backend
+from queues import BoundedQueue
 
 
-async def display_chat(host, port, history):
-    async with manage_socket(host, port) as (reader, _):
+async def read_chat(host, port, history_queue, pattern=None):
+    pattern = re.compile(pattern) if pattern else None
+    stamper = MessageStamper()
+    async with open_session(host, port, stage='read') as session:
+        # every block of lines read at once is printed and queued as one
+        while lines_read := await session.read_batch():
+            messages = stamper.stamp_lines(lines_read, pattern)
+            if messages:
+                text = '\n'.join(messages)
+                print(text)
+                # a full queue stops reading until the disk catches up
+                await history_queue.put(text)
 
-        while True:
-            async with aiofiles.open(history, mode='a') as f:
 
-                chat_message = await reader.read(1000)
-                timestamp = datetime.datetime.now().strftime("%d.%m.%y %H.%M")
+async def display_chat(host, port, history, batch_size=64 * 1024,
+                       flush_interval=0.5, durability='flush', pattern=None,
+                       backend=None, index=None, queue_size=64):
+    # the queue holds blocks of up to CHUNK_SIZE bytes of messages
+    history_queue = BoundedQueue(queue_size, 'block', 'history')
+    history_writer = HistoryWriter(history, history_queue, batch_size,
+                                   flush_interval, durability, backend, index)
 
-                try:
-                    chat_message = chat_message.decode()
-                    formatted_message = f'[{timestamp}] {chat_message}'
-                    print(formatted_message)
-                    await f.write(formatted_message)
-                except Exception as e:
-                    formatted_message = f'[{timestamp} {str(e)}] '
-                    print(formatted_message)
+    async with create_task_group() as tg:
+        tg.start_soon(history_writer.run)
+        await read_chat(host, port, history_queue, pattern)
+        # the server closed the chat: the history writer never returns on
+        # its own, it writes what is left when cancelled
+        tg.cancel_scope.cancel()
 
 
 if __name__ == '__main__':
@@ -34,10 +49,57 @@ if __name__ == '__main__':
         '--port', type=int, help='Host port', env_var='MAIN_PORT',
         default=5000
     )
+    add_history_arguments(parser)
+    metrics.add_metrics_arguments(parser)
     parser.add_argument(
-        '--history', type=str, default='./log.txt',
-        help='Path to the log file', env_var='HISTORY_PATH'
+        '--filter', type=str,
+        help='Show and save only messages matching this regular expression',
+        env_var='MAIN_FILTER'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='Decode, filter and format the chat in this many processes',
+        env_var='MAIN_WORKERS'
+    )
+    parser.add_argument(
+        '--max_pending', type=int,
+        help='Max batches waiting for the workers before the socket is not '
+             'read any more, twice the workers by default',
+        env_var='MAIN_MAX_PENDING'
+    )
+    parser.add_argument(
+        '--history_queue_blocks', type=int, default=64,
+        help='Max blocks of messages waiting to be written to history '
+             'before the socket is not read any more',
+        env_var='MAIN_HISTORY_QUEUE_BLOCKS'
     )
     args = parser.parse_args()
 
-    asyncio.run(display_chat(args.host, args.port, args.history))
+    backend = make_history_backend(
+        args.history, args.history_durability, args.history_format,
+        args.history_rotate_size, args.history_rotate_interval,
+        args.history_compression
+    )
+    index = None
+    if args.history_search:
+        from search import SearchIndex
+        index = SearchIndex(args.history, args.history_format)
+    if args.workers:
+        # the process pool is loaded only for the fan-out mode
+        from fanout import display_chat_fanout
+        chat = display_chat_fanout(
+            args.host, args.port, args.history, args.workers,
+            args.max_pending, args.filter, args.history_batch_size,
+            args.history_flush_interval, args.history_durability, backend,
+            index, args.history_queue_blocks
+        )
+    else:
+        chat = display_chat(
+            args.host, args.port, args.history, args.history_batch_size,
+            args.history_flush_interval, args.history_durability, args.filter,
+            backend, index, args.history_queue_blocks
+        )
+    asyncio.run(metrics.run_exported(
+        chat, args.metrics_host, args.metrics_port, args.metrics_dump,
+        args.metrics_interval
+    ))
@@ -1,20 +1,23 @@
 import asyncio
-import datetime
-import json
 import logging
 import time
 from functools import partial
-from socket import gaierror
-from tkinter import messagebox
 
-import aiofiles
-import async_timeout
 import configargparse
 from anyio import ExceptionGroup, create_task_group
 from exceptiongroup import catch
 
-import gui
-from common import MessageFormatError, manage_socket
+import events
+import metrics
+from common import (BatchSender, InvalidToken, MessageStamper,
+                    add_send_arguments, open_session)
+from connection import (IdleWatch, Keepalive, ReconnectScheduler,
+                        add_keepalive_arguments, add_reconnect_arguments)
+from credentials import Credentials
+from history import HistoryPager, HistoryWriter
+from history_records import (add_history_arguments, make_history_backend,
+                             make_history_store)
+from queues import QUEUE_POLICIES, BoundedQueue, CoalescingQueue
 
 logger = logging.getLogger('watchdog_logger')
 watchdog_logger = logging.getLogger('watchdog_logger')
@@ -22,183 +25,224 @@ watchdog_logger = logging.getLogger('watchdog_logger')
 
 def set_both_statuses(status_updates_queue, status):
     status_updates_queue.put_nowait(
-        gui.ReadConnectionStateChanged.__members__.get(status))
+        events.ReadConnectionStateChanged.__members__.get(status))
     status_updates_queue.put_nowait(
-        gui.SendingConnectionStateChanged.__members__.get(status))
+        events.SendingConnectionStateChanged.__members__.get(status))
 
 
-async def write_to_socket(writer, messages):
-    try:
-        for message in messages:
-            writer.write(message.encode())
-    except AttributeError:
-        raise MessageFormatError
-    await writer.drain()
+async def load_history(history_store, history_pager, messages_queue):
+    for msg in history_pager.tail():
+        await messages_queue.put(msg)
+    await asyncio.to_thread(history_store.update_index)
 
 
-async def read_from_socket(reader):
-    chat_message = await reader.read(1000)
-    decoded_msg = chat_message.decode()
-    logger.debug(decoded_msg)
-    return decoded_msg
+async def read_responses(session, sender, keepalive, watchdog_queue):
+    while True:
+        responses = await session.read_batch()
+        if not responses:
+            raise ConnectionResetError('Writer connection closed')
+        keepalive.on_data()
+        for response in responses:
+            sender.on_response(response)
+        logger.debug(responses)
+        watchdog_queue.put_nowait('Connection is alive. Answer from server')
+
+
+def handle_connection_error(status_updates_queue, event, exc):
+    logger.error(f'Connection error: {exc!r}')
+    status_updates_queue.put_nowait(event)
 
 
-async def load_history(filepath, messages_queue):
-    try:
-        async with aiofiles.open(filepath, mode='r') as f:
-            msgs = await f.read()
-            for msg in msgs.split('\n'):
-                messages_queue.put_nowait(msg)
-    except FileNotFoundError:
-        logger.error(f'File not found: {filepath}')
+async def reconnect_later(status_updates_queue, scheduler, connection,
+                          uptime):
+    scheduler.on_disconnect(uptime)
+    metrics.counter('chat_reconnects_total', 'Reconnects',
+                    connection=connection).inc()
+    delay = scheduler.next_delay()
+    logger.debug(f'Reconnecting {connection} in {delay:.1f}s, '
+                 f'circuit {scheduler.state}')
+    status_updates_queue.put_nowait(
+        events.ReconnectScheduled(connection, delay, scheduler.state))
+    await asyncio.sleep(delay)
 
 
-async def ping_pong(w_reader, w_writer):
+async def keep_reading(
+    host, port, messages_queue, messages_history_queue, status_updates_queue,
+    watchdog_queue, scheduler, idle_timeout=10.0
+):
+    loop = asyncio.get_running_loop()
     while True:
+        status_updates_queue.put_nowait(
+            events.ReadConnectionStateChanged.INITIATED)
+        connected_at = loop.time()
         try:
-            async with async_timeout.timeout(1):
-                await write_to_socket(w_writer, [''])
-                await read_from_socket(w_reader)
-        except asyncio.TimeoutError:
-            raise gaierror
-        await asyncio.sleep(1)
-
-
-def handle_gaierror_error(status_updates_queue, exc: gaierror):
-    set_both_statuses(status_updates_queue, 'INITIATED')
-
-
-def handle_os_error(status_updates_queue, exc: OSError):
-    set_both_statuses(status_updates_queue, 'INITIATED')
-
-
-async def handle_connection(
-    host, port, writer_port, history_path, messages_queue,
-    messages_history_queue, status_updates_queue, watchdog_queue,
-    sending_queue
+            with catch({
+                OSError: partial(handle_connection_error, status_updates_queue,
+                                 events.ReadConnectionStateChanged.CLOSED)
+            }):
+                async with open_session(host, port, stage='read') as session:
+                    connected_at = loop.time()
+                    await read_msgs(
+                        session, messages_queue,
+                        messages_history_queue, status_updates_queue,
+                        watchdog_queue, idle_timeout
+                    )
+        except ExceptionGroup as e:
+            # anyio 3 raises its own group when several tasks fail at once
+            # and catch() does not look into it
+            handle_connection_error(
+                status_updates_queue,
+                events.ReadConnectionStateChanged.CLOSED, e)
+        await reconnect_later(status_updates_queue, scheduler, 'read',
+                              loop.time() - connected_at)
+
+
+async def keep_sending(
+    host, writer_port, status_updates_queue, watchdog_queue, sending_queue,
+    sender, keepalive, scheduler, credentials
 ):
-
-    await load_history(history_path, messages_queue)
-
+    loop = asyncio.get_running_loop()
     while True:
+        status_updates_queue.put_nowait(
+            events.SendingConnectionStateChanged.INITIATED)
+        connected_at = loop.time()
         try:
             with catch({
-                gaierror: partial(handle_gaierror_error,
-                                  status_updates_queue),
-                OSError: partial(handle_os_error,
-                                 status_updates_queue)
+                OSError: partial(handle_connection_error, status_updates_queue,
+                                 events.SendingConnectionStateChanged.CLOSED)
             }):
-                async with manage_socket(host, writer_port) as (
-                    w_reader, w_writer):
-                    async with manage_socket(host, port) as (r_reader, _):
-
-                        await login(w_reader, w_writer, status_updates_queue,
-                            watchdog_queue)
-
-                        async with create_task_group() as tg:
-                            tg.start_soon(send_msgs,
-                                w_writer, sending_queue,
-                                watchdog_queue
-                            )
-                            tg.start_soon(read_msgs,
-                                r_reader, history_path,
-                                messages_queue, messages_history_queue,
-                                status_updates_queue, watchdog_queue
-                            )
-                            tg.start_soon(ping_pong, w_reader, w_writer)
-        except ExceptionGroup:
-            await asyncio.sleep(1)
-
-
-async def send_msgs(w_writer, sending_queue, watchdog_queue):
-    while True: 
-        message = await sending_queue.get()
-        await write_to_socket(w_writer, [message, '\n', '\n'])
-        logger.debug(f'Sent message: {message}')
-        watchdog_queue.put_nowait('Connection is alive. Message sent')
+                async with open_session(host, writer_port,
+                                        stage='send') as session:
+                    connected_at = loop.time()
+                    await login(session, status_updates_queue,
+                        watchdog_queue, credentials)
+                    # messages the previous connection did not confirm go
+                    # first
+                    await sender.resend(session.writer)
+
+                    async with create_task_group() as tg:
+                        tg.start_soon(send_msgs,
+                            session.writer, sending_queue, watchdog_queue,
+                            sender
+                        )
+                        tg.start_soon(read_responses,
+                            session, sender, keepalive, watchdog_queue
+                        )
+                        tg.start_soon(keepalive.run, session.writer, sender)
+        except ExceptionGroup as e:
+            handle_connection_error(
+                status_updates_queue,
+                events.SendingConnectionStateChanged.CLOSED, e)
+        await reconnect_later(status_updates_queue, scheduler, 'send',
+                              loop.time() - connected_at)
 
 
-async def save_message(history_path, queue):
-    async with aiofiles.open(history_path, mode='a') as history_file:
-        msg = await queue.get()
-        await history_file.write(msg)
-        await history_file.flush()
+async def handle_connection(
+    host, port, writer_port, messages_queue, messages_history_queue,
+    status_updates_queue, watchdog_queue, sending_queue, sender, keepalive,
+    read_scheduler, send_scheduler, credentials, read_idle_timeout=10.0
+):
+    # the connections recover independently: a broken writer does not
+    # interrupt the chat stream and the other way round
+    async with create_task_group() as tg:
+        tg.start_soon(keep_reading,
+            host, port, messages_queue, messages_history_queue,
+            status_updates_queue, watchdog_queue, read_scheduler,
+            read_idle_timeout
+        )
+        tg.start_soon(keep_sending,
+            host, writer_port, status_updates_queue, watchdog_queue,
+            sending_queue, sender, keepalive, send_scheduler, credentials
+        )
+
+
+async def send_msgs(w_writer, sending_queue, watchdog_queue, sender):
+    while True:
+        messages = await sender.collect(sending_queue)
+        await sender.send(w_writer, messages)
+        logger.debug(f'Sent messages: {messages}')
+        watchdog_queue.put_nowait('Connection is alive. Message sent')
 
 
 async def read_msgs(
-    r_reader, history_path, messages_queue, messages_history_queue,
-    status_updates_queue, watchdog_queue
+    session, messages_queue, messages_history_queue, status_updates_queue,
+    watchdog_queue, idle_timeout=10.0
 ):
-    while True:
-        try:
-            async with async_timeout.timeout(1) as cm:
-                chat_message = await read_from_socket(r_reader)
-            set_both_statuses(status_updates_queue, 'ESTABLISHED')
+    received = metrics.counter('chat_messages_received_total',
+                               'Chat messages received')
+    stamper = MessageStamper()
+
+    def on_idle():
+        status_updates_queue.put_nowait(events.ReadConnectionStateChanged.IDLE)
+        watchdog_queue.put_nowait(f'No messages for {idle_timeout}s')
+
+    # the status changes only when the stream starts or stops being quiet
+    idle_watch = IdleWatch(
+        idle_timeout, on_idle,
+        lambda: status_updates_queue.put_nowait(
+            events.ReadConnectionStateChanged.ESTABLISHED)
+    )
+    async with create_task_group() as tg:
+        tg.start_soon(idle_watch.run)
+        while True:
+            chat_messages = await session.read_batch()
+            if not chat_messages:
+                raise ConnectionResetError('Connection closed by the server')
+            idle_watch.on_data()
             watchdog_queue.put_nowait(
                 'Connection is alive. New message in chat')
-        except asyncio.TimeoutError:
-            if cm.expired:
-                watchdog_queue.put_nowait('1s timeout is elapsed')
-            chat_message = None
-        timestamp = datetime.datetime.now().strftime("%d.%m.%y %H.%M")
-
-        if chat_message:
-            try:
-                formatted_message = f'[{timestamp}] {chat_message}'
-                messages_queue.put_nowait(formatted_message)
-                messages_history_queue.put_nowait(formatted_message)
-                await save_message(history_path, messages_history_queue)
-            except Exception as e:
-                formatted_message = f'[{timestamp}] {str(e)}'
-                messages_queue.put_nowait(formatted_message)
+            logger.debug(chat_messages)
+
+            for chat_message in chat_messages:
+                if not chat_message:
+                    continue
+                received.inc()
+                try:
+                    formatted_message = stamper.stamp(chat_message)
+                    # a full queue with the block policy stops reading here
+                    await messages_queue.put(formatted_message)
+                    await messages_history_queue.put(formatted_message)
+                except Exception as e:
+                    formatted_message = stamper.stamp(str(e))
+                    messages_queue.put_nowait(formatted_message)
 
 
 def exit_on_token_error():
     print('Unknown token. Check it or register again.')
+    from tkinter import messagebox
     messagebox.showerror(
         "Error", "Unknown token. Check it or register again.")
     raise SystemExit
 
 
-async def process_token():
-    try:
-        async with aiofiles.open('.token', mode='r') as f:
-            token = await f.read()
-    except FileNotFoundError:
-        logger.error('File with token was not found')
-    return token
-
+async def login(session, status_updates_queue, watchdog_queue, credentials):
+    started = time.perf_counter()
+    token = await credentials.get_token()
+    nickname = credentials.get_nickname(token)
+    if nickname:
+        status_updates_queue.put_nowait(events.NicknameReceived(nickname))
 
-async def login(w_reader, w_writer, status_updates_queue, watchdog_queue):
-    await read_from_socket(w_reader)
+    logger.debug(await session.read_greeting())
     watchdog_queue.put_nowait('Connection is alive. Prompt before auth')
     status_updates_queue.put_nowait(
-        gui.SendingConnectionStateChanged.ESTABLISHED)
+        events.SendingConnectionStateChanged.ESTABLISHED)
 
-    token = await process_token()
+    # InvalidToken is left to the caller, only the GUI shows a dialog
     try:
-        await write_to_socket(w_writer, [token, '\n'])
-    except MessageFormatError:
-        exit_on_token_error()
-    
-    answer = None
-    while not answer or answer == "\n":
-        answer = await read_from_socket(w_reader)
-
-    try:
-        answer = answer.split('\n')[0]
-        answer = json.loads(answer)
-        if not answer:
-            exit_on_token_error()
-    except Exception as e:
+        answer = await session.login(token, greeting=False)
+    except ValueError as e:
         logger.error(f'Error loading token: {str(e)}')
         raise SystemExit
 
     logger.debug(
         f'Authorization complete. User {answer["nickname"]}.')
-    event = gui.NicknameReceived(answer["nickname"])
-    status_updates_queue.put_nowait(event)
+    if answer['nickname'] != nickname:
+        credentials.remember_nickname(token, answer['nickname'])
+        event = events.NicknameReceived(answer["nickname"])
+        status_updates_queue.put_nowait(event)
     watchdog_queue.put_nowait('Connection is alive. Authorization done')
+    metrics.histogram('chat_login_seconds', 'Login duration').observe(
+        time.perf_counter() - started)
 
 
 async def watch_for_connection(watchdog_queue):
@@ -220,15 +264,65 @@ def parse_args():
         env_var='WRITER_PORT', default=5050
     )
     parser.add_argument(
-        '--history', type=str, default='./log.txt',
-        help='Path to the log file', env_var='HISTORY_PATH'
+        '--profile', type=str,
+        help='Use the token saved for this profile in .token.<profile>',
+        env_var='PROFILE'
+    )
+    add_history_arguments(parser)
+    parser.add_argument(
+        '--history_page', type=int, default=200,
+        help='Number of history messages shown at startup and loaded on '
+             'scrolling to the top', env_var='HISTORY_PAGE'
+    )
+    parser.add_argument(
+        '--scrollback', type=int, default=5000,
+        help='Max number of messages kept on screen, older ones are loaded '
+             'back from the history', env_var='SCROLLBACK'
+    )
+    parser.add_argument(
+        '--messages_queue_size', type=int, default=10000,
+        help='Max messages waiting to be shown', env_var='MESSAGES_QUEUE_SIZE'
+    )
+    parser.add_argument(
+        '--messages_queue_policy', type=str, default='drop-oldest',
+        choices=QUEUE_POLICIES,
+        help='What to do when the screen does not keep up: block reading '
+             'or drop the oldest messages, they are in the history anyway',
+        env_var='MESSAGES_QUEUE_POLICY'
+    )
+    parser.add_argument(
+        '--history_queue_size', type=int, default=100000,
+        help='Max messages waiting to be written to history',
+        env_var='HISTORY_QUEUE_SIZE'
     )
+    parser.add_argument(
+        '--history_queue_policy', type=str, default='block',
+        choices=QUEUE_POLICIES,
+        help='What to do when the disk does not keep up: block reading or '
+             'drop the oldest messages', env_var='HISTORY_QUEUE_POLICY'
+    )
+    parser.add_argument(
+        '--sending_queue_size', type=int, default=1000,
+        help='Max messages waiting to be sent, a message that does not fit '
+             'stays in the input field', env_var='SENDING_QUEUE_SIZE'
+    )
+    metrics.add_metrics_arguments(parser)
+    add_send_arguments(parser)
+    parser.add_argument(
+        '--read_idle_timeout', type=float, default=10.0,
+        help='Show the chat as quiet after this many seconds without '
+             'messages', env_var='READ_IDLE_TIMEOUT'
+    )
+    add_keepalive_arguments(parser)
+    add_reconnect_arguments(parser)
     return parser.parse_args()
 
 
 async def main():
-    
     args = parse_args()
+    # Tk is loaded only by the app itself, not by the headless users of
+    # this module or by --help
+    import gui
 
     logging.basicConfig(
         format=(
@@ -238,11 +332,57 @@ async def main():
         level=logging.DEBUG
     )
 
-    messages_queue = asyncio.Queue()
-    messages_history_queue = asyncio.Queue()
-    sending_queue = asyncio.Queue()
-    status_updates_queue = asyncio.Queue()
-    watchdog_queue = asyncio.Queue()
+    messages_queue = BoundedQueue(
+        args.messages_queue_size, args.messages_queue_policy, 'messages')
+    messages_history_queue = BoundedQueue(
+        args.history_queue_size, args.history_queue_policy,
+        'messages_history')
+    sending_queue = BoundedQueue(args.sending_queue_size, 'block', 'sending')
+    # the status panel only hears about real changes, and the watchdog
+    # events are counted in the metrics
+    status_updates_queue = events.StatusState()
+    watchdog_queue = CoalescingQueue(name='watchdog', count_keys=True)
+
+    history_store = make_history_store(args.history, args.history_format)
+    history_pager = HistoryPager(history_store, args.history_page)
+    search_index = None
+    if args.history_search:
+        from search import SearchIndex
+        search_index = SearchIndex(args.history, args.history_format)
+    history_writer = HistoryWriter(
+        args.history, messages_history_queue, args.history_batch_size,
+        args.history_flush_interval, args.history_durability,
+        make_history_backend(
+            args.history, args.history_durability, args.history_format,
+            args.history_rotate_size, args.history_rotate_interval,
+            args.history_compression
+        ),
+        search_index
+    )
+
+    sender = BatchSender(args.send_batch_size, args.send_high_water,
+                         args.send_rate_limit)
+
+    keepalive = Keepalive(args.keepalive_interval,
+                          args.keepalive_min_timeout,
+                          args.keepalive_max_timeout)
+
+    status_updates_queue.watch(
+        'rtt', lambda: keepalive.srtt and keepalive.srtt * 1000,
+        'RTT {:.0f} ms')
+    status_updates_queue.watch_rate(
+        'received', lambda: metrics.counter(
+            'chat_messages_received_total', 'Chat messages received').value,
+        '{:.0f} msg/s')
+    status_updates_queue.watch('queue', messages_queue.qsize, 'queue {}')
+
+    read_scheduler, send_scheduler = (
+        ReconnectScheduler(args.reconnect_base_delay,
+                           args.reconnect_max_delay,
+                           args.circuit_failure_threshold,
+                           args.circuit_cooldown)
+        for _ in range(2)
+    )
 
     set_both_statuses(status_updates_queue, 'INITIATED')
 
@@ -250,16 +390,36 @@ async def main():
         async with create_task_group() as tg:
             tg.start_soon(watch_for_connection, watchdog_queue)
 
+            if args.metrics_port:
+                tg.start_soon(metrics.serve_metrics, args.metrics_host,
+                    args.metrics_port)
+            if args.metrics_dump:
+                tg.start_soon(metrics.dump_metrics, args.metrics_dump,
+                    args.metrics_interval)
+
+            tg.start_soon(history_writer.run)
+
+            tg.start_soon(load_history, history_store, history_pager,
+                messages_queue)
+
             tg.start_soon(gui.draw, messages_queue, sending_queue,
-                status_updates_queue)
+                status_updates_queue, history_pager, args.scrollback,
+                search_index and search_index.search)
 
             tg.start_soon(handle_connection, args.host, args.port,
-                args.writer_port, args.history, messages_queue,
+                args.writer_port, messages_queue,
                 messages_history_queue, status_updates_queue, watchdog_queue,
-                sending_queue)
+                sending_queue, sender, keepalive, read_scheduler,
+                send_scheduler, Credentials(args.profile),
+                args.read_idle_timeout)
 
     except gui.TkAppClosed:
         logger.info("Exit the app")
+    except InvalidToken:
+        exit_on_token_error()
+    finally:
+        history_writer.close()
+        history_store.close()
 
 
 if __name__ == '__main__':
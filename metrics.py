@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a fast Tk frame to a slow login
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 4, 16, 64, 256, 1024, 4096, 16384)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    # the value is read from a callback when the metrics are exported, so
+    # queue depths cost nothing on the hot path
+    kind = 'gauge'
+
+    def __init__(self, read=None):
+        self.read = read
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def sample(self):
+        return self.read() if self.read else self.value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def sample(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip(map(str, self.buckets + ('+Inf',)),
+                                    self.counts))}
+
+
+class Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+
+    def get(self, cls, name, help_text, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = cls(*args)
+            self.help.setdefault(name, (help_text, cls.kind))
+        return metric
+
+    def as_dict(self):
+        result = {}
+        for (name, labels), metric in self.metrics.items():
+            key = name
+            if labels:
+                key += '{' + ','.join(f'{k}={v}' for k, v in labels) + '}'
+            result[key] = metric.sample()
+        return result
+
+    def as_text(self):
+        # Prometheus text exposition format
+        lines = []
+        described = set()
+        for (name, labels), metric in sorted(self.metrics.items(),
+                                             key=lambda item: item[0]):
+            if name not in described:
+                help_text, kind = self.help[name]
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                described.add(name)
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} '
+                             f'{metric.sample()}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',),
+                                    metric.counts):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{format_labels(labels, le=bound)} '
+                    f'{cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {metric.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} '
+                         f'{metric.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+registry = Registry()
+
+
+def counter(name, help_text, **labels):
+    return registry.get(Counter, name, help_text, labels)
+
+
+def gauge(name, help_text, read=None, **labels):
+    return registry.get(Gauge, name, help_text, labels, read)
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS, **labels):
+    return registry.get(Histogram, name, help_text, labels, buckets)
+
+
+def watch_queues(**queues):
+    for name, queue in queues.items():
+        gauge('chat_queue_depth', 'Items waiting in a queue',
+              queue=name).read = queue.qsize
+
+
+async def handle_scrape(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = registry.as_text().encode()
+        writer.write(
+            b'HTTP/1.0 200 OK\r\n'
+            b'Content-Type: text/plain; version=0.0.4\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' +
+            body
+        )
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_metrics(host, port):
+    server = await asyncio.start_server(handle_scrape, host, port)
+    logger.info(f'Metrics on http://{host}:{port}/metrics')
+    async with server:
+        await server.serve_forever()
+
+
+def write_dump(path):
+    import json
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'time': time.time(), 'metrics': registry.as_dict()}, f)
+    os.replace(tmp_path, path)
+
+
+async def run_exported(coro, host, port, dump_path, interval):
+    # runs `coro` and exports the metrics meanwhile as configured
+    from anyio import create_task_group
+
+    async with create_task_group() as tg:
+        if port:
+            tg.start_soon(serve_metrics, host, port)
+        if dump_path:
+            tg.start_soon(dump_metrics, dump_path, interval)
+        await coro
+        tg.cancel_scope.cancel()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        '--metrics_port', type=int,
+        help='Serve metrics in the Prometheus text format on this port',
+        env_var='METRICS_PORT'
+    )
+    parser.add_argument(
+        '--metrics_host', type=str, default='127.0.0.1',
+        help='Address of the metrics endpoint', env_var='METRICS_HOST'
+    )
+    parser.add_argument(
+        '--metrics_dump', type=str,
+        help='Write metrics as JSON to this file periodically',
+        env_var='METRICS_DUMP'
+    )
+    parser.add_argument(
+        '--metrics_interval', type=float, default=10.0,
+        help='Seconds between metrics dumps', env_var='METRICS_INTERVAL'
+    )
+
+
+async def dump_metrics(path, interval):
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            write_dump(path)
+    finally:
+        write_dump(path)
@@ -0,0 +1,234 @@
+import asyncio
+import json
+import logging
+import uuid
+
+import configargparse
+
+from common import MESSAGE_SENT, LineReader
+
+logger = logging.getLogger(__name__)
+
+GREETING = ('Hello %username%! Enter your personal hash or leave it empty '
+            'to create new account.')
+NICKNAME_PROMPT = 'Enter preferred nickname below:'
+WELCOME = ('Welcome to chat! Post your message below. End it with an empty '
+           'line.')
+
+
+class MockChatServer:
+    # Offline stand-in for minechat: the reader port broadcasts the chat,
+    # the writer port greets, logs in or registers and accepts messages.
+
+    def __init__(self, on_message=None,
+                 reader_buffer_limit=16 * 1024 * 1024):
+        self.accounts = {}
+        self.readers = set()
+        self.on_message = on_message
+        self.reader_buffer_limit = reader_buffer_limit
+        self._servers = []
+
+    def register(self, nickname):
+        account = {'nickname': nickname, 'account_hash': uuid.uuid4().hex}
+        self.accounts[account['account_hash']] = account
+        return account
+
+    def broadcast(self, *messages):
+        data = ''.join(f'{message}\n' for message in messages).encode()
+        for writer in list(self.readers):
+            if writer.transport.get_write_buffer_size() > \
+                    self.reader_buffer_limit:
+                logger.warning('Dropping a reader that does not keep up')
+                writer.close()
+                self.readers.discard(writer)
+                continue
+            writer.write(data)
+
+    async def drain_readers(self):
+        for writer in list(self.readers):
+            try:
+                await writer.drain()
+            except OSError:
+                self.readers.discard(writer)
+
+    async def handle_reader(self, reader, writer):
+        self.readers.add(writer)
+        try:
+            while await reader.read(1024):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.readers.discard(writer)
+            writer.close()
+
+    async def _send(self, writer, *lines):
+        writer.write(''.join(f'{line}\n' for line in lines).encode())
+        await writer.drain()
+
+    async def handle_writer(self, reader, writer):
+        lines = LineReader(reader, stage='mock')
+        try:
+            await self._send(writer, GREETING)
+            token = (await lines.readline()).strip()
+            if token:
+                account = self.accounts.get(token)
+                if not account:
+                    await self._send(writer, 'null')
+                    return
+            else:
+                await self._send(writer, NICKNAME_PROMPT)
+                nickname = (await lines.readline()).strip()
+                account = self.register(nickname or 'anonymous')
+            await self._send(writer, json.dumps(account), WELCOME)
+
+            message = []
+            async for line in lines:
+                if line:
+                    message.append(line)
+                    continue
+                if message:
+                    text = '\n'.join(message)
+                    message = []
+                    self.broadcast(f'{account["nickname"]}: {text}')
+                    if self.on_message:
+                        self.on_message(account['nickname'], text)
+                await self._send(writer, MESSAGE_SENT)
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=0, writer_port=0):
+        reader_server = await asyncio.start_server(
+            self.handle_reader, host, port)
+        writer_server = await asyncio.start_server(
+            self.handle_writer, host, writer_port)
+        self._servers = [reader_server, writer_server]
+        return (reader_server.sockets[0].getsockname()[1],
+                writer_server.sockets[0].getsockname()[1])
+
+    async def close(self):
+        for writer in list(self.readers):
+            writer.close()
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+
+    async def generate_traffic(self, rate, count, make_message,
+                               tick=0.005, burst=1000):
+        # broadcasts `count` messages, `rate` per second or as fast as the
+        # readers take them when rate is 0
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        sent = 0
+        while sent < count:
+            if rate:
+                due = min(count, int((loop.time() - started) * rate) + 1)
+            else:
+                due = min(count, sent + burst)
+            self.broadcast(*(make_message(seq) for seq in range(sent, due)))
+            sent = due
+            await self.drain_readers()
+            await asyncio.sleep(tick if rate else 0)
+
+    async def replay(self, records, speed, tick=0.005, burst=1000):
+        # Broadcasts the (timestamp, text) records of a history at their
+        # original pace sped up `speed` times, or as fast as the readers
+        # take them when speed is 0. A history only knows the minute of a
+        # message, so the messages of one minute are spread over it.
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = None
+        sent = 0
+        for timestamp, texts in minute_groups(records):
+            if not speed:
+                for start in range(0, len(texts), burst):
+                    self.broadcast(*texts[start:start + burst])
+                    await self.drain_readers()
+                    await asyncio.sleep(0)
+                sent += len(texts)
+                continue
+            if first is None:
+                first = timestamp
+            for seq, text in enumerate(texts):
+                due = started + (
+                    timestamp - first + 60 * seq / len(texts)) / speed
+                if due - loop.time() > tick:
+                    await self.drain_readers()
+                    await asyncio.sleep(due - loop.time())
+                self.broadcast(text)
+            sent += len(texts)
+        await self.drain_readers()
+        return sent
+
+
+def minute_groups(records):
+    # consecutive records of the same minute, lines without a time join the
+    # minute before them
+    current, texts = None, []
+    for timestamp, text in records:
+        if timestamp and timestamp != current:
+            if texts:
+                yield current or timestamp, texts
+            current, texts = timestamp, []
+        texts.append(text)
+    if texts:
+        yield current or 0, texts
+
+
+async def serve(host, port, writer_port, rate, tokens):
+    server = MockChatServer()
+    for nickname in tokens:
+        account = server.register(nickname)
+        print(f'{nickname}: {account["account_hash"]}')
+    port, writer_port = await server.start(host, port, writer_port)
+    logger.info(f'Listening on {host}:{port} (reader) and '
+                f'{host}:{writer_port} (writer)')
+    try:
+        if rate:
+            await server.generate_traffic(
+                rate, float('inf'), lambda seq: f'mock: message {seq}')
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--host', type=str, help='Address to listen on',
+        env_var='MOCK_HOST', default='127.0.0.1'
+    )
+    parser.add_argument(
+        '--port', type=int, help='Reader port', env_var='MOCK_PORT',
+        default=5000
+    )
+    parser.add_argument(
+        '--writer_port', type=int, help='Writer port',
+        env_var='MOCK_WRITER_PORT', default=5050
+    )
+    parser.add_argument(
+        '--rate', type=float, default=0,
+        help='Broadcast this many generated messages per second',
+        env_var='MOCK_RATE'
+    )
+    parser.add_argument(
+        '--account', type=str, action='append', default=[],
+        help='Register an account with this nickname and print its token'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format=(
+            '%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s] '
+            '%(message)s'
+        ),
+        level=logging.INFO
+    )
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.writer_port, args.rate,
+                          args.account))
+    except KeyboardInterrupt:
+        logger.info('Exit the server with CTRL+C')
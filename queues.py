@@ -0,0 +1,75 @@
+import asyncio
+from collections import OrderedDict
+
+import metrics
+
+QUEUE_POLICIES = ('block', 'drop-oldest')
+
+
+class BoundedQueue(asyncio.Queue):
+    # With "block" a full queue makes put() wait, which slows the producer
+    # down to the consumer, and put_nowait() raise QueueFull as usual. With
+    # "drop-oldest" neither of them ever waits: the oldest item makes room
+    # for the new one.
+
+    def __init__(self, maxsize, policy='block', name='queue'):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f'Unknown queue policy: {policy}')
+        super().__init__(maxsize)
+        self.policy = policy
+        self._dropped = metrics.counter(
+            'chat_queue_dropped_total', 'Items dropped from a full queue',
+            queue=name)
+        self._full = metrics.counter(
+            'chat_queue_full_total', 'Puts that found a queue full',
+            queue=name)
+        metrics.watch_queues(**{name: self})
+
+    def put_nowait(self, item):
+        if self.full():
+            self._full.inc()
+            if self.policy == 'drop-oldest':
+                self._get()
+                self._dropped.inc()
+        super().put_nowait(item)
+
+    async def put(self, item):
+        if self.policy == 'drop-oldest':
+            return self.put_nowait(item)
+        if self.full():
+            self._full.inc()
+        return await super().put(item)
+
+
+class CoalescingQueue(asyncio.Queue):
+    # Keeps only the latest item for every key, so the queue can not grow
+    # beyond the number of keys however slow the consumer is. An item that
+    # replaces an older one moves to the end. With `count_keys` every put is
+    # also counted per key in the metrics.
+
+    def __init__(self, key=None, name='queue', count_keys=False):
+        super().__init__()
+        self.key = key or (lambda item: item)
+        self.name = name
+        self.count_keys = count_keys
+        self._coalesced = metrics.counter(
+            'chat_queue_coalesced_total',
+            'Items replaced by a newer one with the same key', queue=name)
+        metrics.watch_queues(**{name: self})
+
+    def _init(self, maxsize):
+        self._queue = OrderedDict()
+
+    def _put(self, item):
+        key = self.key(item)
+        if self.count_keys:
+            metrics.counter('chat_queue_events_total', 'Items put by key',
+                            queue=self.name, key=key).inc()
+        if self._queue.pop(key, None) is not None:
+            self._coalesced.inc()
+            # the replaced item was counted as unfinished already
+            self._unfinished_tasks -= 1
+        self._queue[key] = item
+
+    def _get(self):
+        return self._queue.popitem(last=False)[1]
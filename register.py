@@ -1,47 +1,39 @@
 import asyncio
-import json
 import logging
 
-import aiofiles
 import configargparse
 
-from common import manage_socket, write_to_socket
+from common import StdinReader, open_session
+from credentials import Credentials
 
 
-async def read_from_chat(reader):
-    msg = await reader.read(1000)
-    logging.debug(msg.decode())
-    return msg
+async def ask_nickname():
+    stdin = StdinReader()
+    print('Enter preferred nickname:')
+    nickname = ''
+    while not nickname:
+        nickname = await stdin.readline()
+        if nickname is None:
+            raise SystemExit('No nickname was entered')
+        nickname = nickname.strip()
+    return nickname
 
 
-async def register(host, port):
-    async with manage_socket(host, port) as (reader, writer):
-        await read_from_chat(reader)
-        await write_to_socket(writer, ['\n'])
-        await read_from_chat(reader)
+async def register(host, port, profile=None, nickname=None):
+    # the nickname is asked before connecting, so the server does not wait
+    # for the user
+    nickname = nickname or await ask_nickname()
+    async with open_session(host, port) as session:
+        try:
+            answer = await session.register(nickname)
+            token = answer['account_hash']
+            username = answer['nickname']
+        except (ValueError, TypeError, KeyError) as e:
+            logging.error(f'Registration error: {str(e)}')
+            raise
 
-        while True:
-            message = input()
-            await write_to_socket(writer, [message, '\n'])
-
-            if message:
-                logging.debug(f'Sent message: {message}')
-                answer = await read_from_chat(reader)
-                answer = answer.decode().split('\n')[0]
-
-                try:
-                    answer = json.loads(answer)
-                    token = answer['account_hash']
-                    username = answer['nickname']
-
-                    async with aiofiles.open('.token', mode='w') as f:
-                        await f.write(token)
-                    print(f'You are successfully registered as {username}')
-                except Exception as e:
-                    logging.error(f'Registration error: {str(e)}')
-                    raise e
-                finally:
-                    break
+    await Credentials(profile).save_token(token)
+    print(f'You are successfully registered as {username}')
 
 
 if __name__ == '__main__':
@@ -54,6 +46,11 @@ if __name__ == '__main__':
         '--port', required=False, type=int, help='Host port',
         env_var='REG_PORT', default=5050
     )
+    parser.add_argument(
+        '--profile', type=str, required=False,
+        help='Save the token for this profile in .token.<profile>',
+        env_var='PROFILE'
+    )
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -64,4 +61,4 @@ if __name__ == '__main__':
         level=logging.DEBUG
     )
 
-    asyncio.run(register(args.host, args.port))
+    asyncio.run(register(args.host, args.port, args.profile))
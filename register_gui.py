@@ -1,16 +1,13 @@
 import asyncio
-import json
 import tkinter as tk
+from functools import partial
 from tkinter.scrolledtext import ScrolledText
 
-import aiofiles
 from anyio import create_task_group
 
-from common import manage_socket, write_to_socket
-
-
-class TkAppClosed(Exception):
-    pass
+from common import open_session
+from credentials import Credentials
+from gui import TkAppClosed, render_conversation, update_tk
 
 
 def process_new_message(input_field, sending_queue):
@@ -19,57 +16,20 @@ def process_new_message(input_field, sending_queue):
     input_field.delete(0, tk.END)
 
 
-async def update_tk(root_frame, interval=1 / 120):
-    while True:
-        try:
-            root_frame.update()
-        except tk.TclError:
-            # if application has been destroyed/closed
-            raise TkAppClosed()
-        await asyncio.sleep(interval)
-
-
-async def update_conversation_history(panel, messages_queue):
-    while True:
-        msg = await messages_queue.get()
-
-        panel['state'] = 'normal'
-        if panel.index('end-1c') != '1.0':
-            panel.insert('end', '\n')
-        panel.insert('end', msg)
-        panel.yview(tk.END)
-        panel['state'] = 'disabled'
-
-
-async def read_from_chat(reader):
-    msg = await reader.read(1000)
-    decoded_msg = msg.decode()
-    return decoded_msg
-
-
 async def receive_token(messages_queue, chosen_username, host, port):
-    async with manage_socket(host, port) as (reader, writer):
-        await read_from_chat(reader)
-        await write_to_socket(writer, ['\n'])
-        await read_from_chat(reader)
-        await read_from_chat(reader)
-        await write_to_socket(writer, [chosen_username, '\n', '\n'])
-        answer = await read_from_chat(reader)
-        answer = answer.split('\n')[0]
-
+    async with open_session(host, port) as session:
         try:
-            answer = json.loads(answer)
+            answer = await session.register(chosen_username)
             token = answer['account_hash']
             username = answer['nickname']
-
-            async with aiofiles.open('.token', mode='w') as f:
-                await f.write(token)
-            return username
-        except json.decoder.JSONDecodeError:
+        except (ValueError, TypeError, KeyError):
             messages_queue.put_nowait(
                 'Registration error. Please enter your username again')
             return
 
+    await Credentials().save_token(token)
+    return username
+
 
 async def register(messages_queue, sending_queue, host, port):
     messages_queue.put_nowait(
@@ -125,11 +85,12 @@ async def draw():
     port = 5050
     try:
         async with create_task_group() as tg:
-            tg.start_soon(update_tk, root_frame)
+            tg.start_soon(update_tk, root_frame, [
+                partial(render_conversation, conversation_panel,
+                        messages_queue)
+            ])
             tg.start_soon(register, messages_queue, sending_queue,
                           host, port)
-            tg.start_soon(update_conversation_history, conversation_panel,
-                          messages_queue)
     except TkAppClosed:
         print("Exit the app")           
 
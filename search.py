@@ -0,0 +1,225 @@
+import logging
+import os
+import sqlite3
+import time
+
+from history_records import HISTORY_FORMATS, RecordStore, make_history_store
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+    text, tokenize = 'unicode61'
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+'''
+
+
+def quote_query(query):
+    # plain words, every one of them has to be found; FTS5 operators and
+    # punctuation in the query are taken literally
+    return ' '.join('"{}"'.format(word.replace('"', '""'))
+                    for word in query.split())
+
+
+class SearchIndex:
+    # Full-text index of a history in an SQLite FTS5 sidecar
+    # (<path>.fts). The rowid of a message is its history offset: the byte
+    # offset of the line for text, the record number for records, so a
+    # result can be opened with the HistoryPager right away. Only what was
+    # appended since the last update is indexed.
+
+    def __init__(self, path, history_format='text',
+                 chunk_size=4 * 1024 * 1024, records_chunk=50000):
+        self.path = path
+        self.history_format = history_format
+        self.index_path = f'{path}.fts'
+        self.chunk_size = chunk_size
+        self.records_chunk = records_chunk
+        # the history writer thread updates the index through one
+        # connection, searches use the other; WAL lets them run together
+        self._db = None
+        self._search_db = None
+        self._records = None
+
+    def _open(self):
+        db = sqlite3.connect(self.index_path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.executescript(SCHEMA)
+        return db
+
+    def _connect(self):
+        if self._db is None:
+            self._db = self._open()
+        return self._db
+
+    def _position(self, db):
+        row = db.execute(
+            "SELECT value FROM meta WHERE key = 'position'").fetchone()
+        return row[0] if row else 0
+
+    def _reset(self, db):
+        logger.warning(f'History changed, rebuilding {self.index_path}')
+        db.execute('DELETE FROM messages')
+        return 0
+
+    def _insert(self, db, rows):
+        db.executemany('INSERT INTO messages (rowid, text) VALUES (?, ?)',
+                       rows)
+
+    def _update_text(self, db, position):
+        try:
+            f = open(self.path, mode='rb')
+        except FileNotFoundError:
+            return position
+        with f:
+            if os.fstat(f.fileno()).st_size < position:
+                position = self._reset(db)
+            f.seek(position)
+            tail = b''
+            while chunk := f.read(self.chunk_size):
+                lines = (tail + chunk).split(b'\n')
+                # the unfinished last line is indexed next time
+                tail = lines.pop()
+                rows = []
+                for line in lines:
+                    if line:
+                        rows.append(
+                            (position, line.decode(errors='replace')))
+                    position += len(line) + 1
+                self._insert(db, rows)
+        return position
+
+    def _update_records(self, db, position):
+        if self._records is None:
+            self._records = RecordStore(self.path, cached_segments=1)
+        else:
+            self._records.refresh()
+        size = self._records.size
+        if size < position:
+            position = self._reset(db)
+        while position < size:
+            end = min(position + self.records_chunk, size)
+            self._insert(db, enumerate(
+                self._records.read_range(position, end), position))
+            position = end
+        return position
+
+    def update(self):
+        # blocking, the history writer calls it from its thread after every
+        # batch
+        db = self._connect()
+        with db:
+            position = self._position(db)
+            if self.history_format == 'text':
+                new_position = self._update_text(db, position)
+            else:
+                new_position = self._update_records(db, position)
+            if new_position != position:
+                db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('position', ?)",
+                    (new_position,))
+        return new_position
+
+    def search(self, query, limit=100, raw=False):
+        # newest matches first as (offset, line)
+        if not raw:
+            query = quote_query(query)
+        if not query:
+            return []
+        if self._search_db is None:
+            self._search_db = self._open()
+        try:
+            return self._search_db.execute(
+                'SELECT rowid, text FROM messages WHERE messages MATCH ? '
+                'ORDER BY rowid DESC LIMIT ?', (query, limit)
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            logger.error(f'Bad search query {query!r}: {e}')
+            return []
+
+    def close(self):
+        for db in (self._db, self._search_db):
+            if db is not None:
+                db.close()
+        self._db = self._search_db = None
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+
+
+def print_context(store, offset, context):
+    _, before = store.read_before(offset, context)
+    _, after = store.read_after(offset, context + 1)
+    for line in before:
+        print(f'  {line}')
+    if after:
+        print(f'> {after[0]}')
+    for line in after[1:]:
+        print(f'  {line}')
+    print('--')
+
+
+def parse_args():
+    import configargparse
+
+    parser = configargparse.ArgParser()
+    parser.add_argument(
+        '--history', type=str, default='./log.txt',
+        help='Path to the log file', env_var='HISTORY_PATH'
+    )
+    parser.add_argument(
+        '--history_format', type=str, default='text',
+        choices=HISTORY_FORMATS, help='Format of the history',
+        env_var='HISTORY_FORMAT'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('index', help='Bring the search index up to date')
+    query_parser = subparsers.add_parser('query', help='Search the history')
+    query_parser.add_argument('query', type=str)
+    query_parser.add_argument(
+        '--limit', type=int, default=20, help='Max number of results'
+    )
+    query_parser.add_argument(
+        '--context', type=int, default=0,
+        help='Show this many history lines around every result'
+    )
+    query_parser.add_argument(
+        '--raw', action='store_true',
+        help='Pass the query to FTS5 as is: AND, OR, NOT, "phrases", prefix*'
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig(
+        format=(
+            '%(filename)s[LINE:%(lineno)d]# %(levelname)-8s [%(asctime)s] '
+            '%(message)s'
+        ),
+        level=logging.INFO
+    )
+
+    index = SearchIndex(args.history, args.history_format)
+    try:
+        started = time.monotonic()
+        index.update()
+        if args.command == 'index':
+            logger.info(f'Index updated in {time.monotonic() - started:.2f}s')
+        else:
+            started = time.monotonic()
+            results = index.search(args.query, args.limit, args.raw)
+            logger.info(f'{len(results)} results in '
+                        f'{(time.monotonic() - started) * 1000:.1f} ms')
+            store = make_history_store(args.history, args.history_format)
+            for offset, text in results:
+                if args.context:
+                    print_context(store, offset, args.context)
+                else:
+                    print(f'{offset}: {text}')
+            store.close()
+    finally:
+        index.close()
@@ -1,11 +1,10 @@
 import asyncio
-import json
 import logging
+from collections import deque
 
-import aiofiles
-import configargparse
-
-from common import MessageFormatError, manage_socket, write_to_socket
+from common import (BatchSender, ChatSession, InvalidToken, LineReader,
+                    add_send_arguments, open_connection)
+from credentials import Credentials
 
 
 def exit_on_token_error():
@@ -13,52 +12,287 @@ def exit_on_token_error():
     raise SystemExit
 
 
-async def read_from_chat(reader):
-    msg = await reader.read(1000)
-    logging.debug(msg.decode())
-    return msg
+async def login(session, token):
+    try:
+        account = await session.login(token)
+    except InvalidToken:
+        exit_on_token_error()
+    except ValueError as e:
+        logging.error(f'Error loading token: {str(e)}')
+        raise SystemExit
+    logging.debug(f'Logged in successfully as {account["nickname"]}')
+
+
+class WriterSession:
+    # Keeps one logged-in connection open for many messages and logs in
+    # again only after the connection breaks.
 
+    def __init__(self, host, port, token=None, sender=None,
+                 credentials=None, timeout=10.0, keepalive=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.timeout = timeout
+        self.sender = sender or BatchSender()
+        self.credentials = credentials or Credentials()
+        # probes a quiet connection, a half-open one is closed on timeout
+        self.keepalive = keepalive
+        self.reader = None
+        self.writer = None
+        self._responses = None
+        self._probes = None
+        # loop time of the last successful login
+        self.connected_at = None
 
-async def process_token(token):
-    if not token:
+    async def connect(self):
+        token = self.token or await self.credentials.get_token()
+        self.reader, self.writer = await open_connection(
+            self.host, self.port, self.timeout)
+        session = ChatSession(self.reader, self.writer, self.timeout, 'send')
+        await login(session, token)
+        self.connected_at = asyncio.get_running_loop().time()
+        self._responses = asyncio.create_task(
+            self._read_responses(session.iter_messages()))
+        if self.keepalive:
+            self._probes = asyncio.create_task(self._keep_alive())
+
+    async def _read_responses(self, lines):
+        # the server answers every message, keep its replies from piling up
+        # and notice when the connection goes away
+        try:
+            async for line in lines:
+                logging.debug(line)
+                if self.keepalive:
+                    self.keepalive.on_data()
+                self.sender.on_response(line)
+        except OSError:
+            pass
+        logging.debug('Connection closed by the server')
+        self.writer.close()
+
+    async def _keep_alive(self):
         try:
-            async with aiofiles.open('.token', mode='r') as f:
-                token = await f.read()
-        except FileNotFoundError:
-            logging.error('File with token was not found')  
-    return token
+            await self.keepalive.run(self.writer, self.sender)
+        except OSError as e:
+            logging.error(f'Connection error: {str(e)}')
+        self.writer.close()
+
+    async def close(self):
+        if self._responses:
+            self._responses.cancel()
+            self._responses = None
+        if self._probes:
+            self._probes.cancel()
+            self._probes = None
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    async def send(self, message, retries=1):
+        await self.send_batch([message], retries)
+
+    async def send_batch(self, messages, retries=1):
+        # once handed to the sender, a batch is kept in its unacked queue
+        # and is sent again after a reconnect together with anything else
+        # the broken connection did not confirm
+        for attempt in range(retries + 1):
+            try:
+                if self.writer is None or self.writer.is_closing():
+                    await self.close()
+                    await self.connect()
+                    await self.sender.resend(self.writer)
+                if messages:
+                    batch, messages = messages, None
+                    await self.sender.send(self.writer, batch)
+                    logging.debug(f'Sent messages: {batch}')
+                return
+            except OSError as e:
+                logging.error(f'Connection error: {str(e)}')
+                await self.close()
+                if attempt == retries:
+                    raise
 
+    async def __aenter__(self):
+        return self
 
-async def login(reader, writer, token):
-    token = await process_token(token)
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def submit_message(host, port, token, message, sender=None,
+                         credentials=None):
+    async with WriterSession(host, port, token, sender,
+                             credentials) as session:
+        await session.send(message)
+
+
+async def queue_messages(messages, messages_queue):
     try:
-        await write_to_socket(writer, [token, '\n'])
-    except MessageFormatError:
-        exit_on_token_error()
+        async for message in messages:
+            if message:
+                await messages_queue.put(message)
+    except Exception:
+        # the sender still gets the end marker and the error comes from
+        # the task once it is awaited
+        await messages_queue.put(None)
+        raise
+    await messages_queue.put(None)
+
+
+async def submit_messages(host, port, token, messages, sender=None,
+                          credentials=None):
+    sender = sender or BatchSender()
+    messages_queue = asyncio.Queue(maxsize=sender.batch_size * 4)
+    source = asyncio.create_task(queue_messages(messages, messages_queue))
 
-    answer = await read_from_chat(reader)
-    answer = answer.decode().split('\n')[0]
-    
     try:
-        if not json.loads(answer):
-            exit_on_token_error()
-    except Exception as e:
-        logging.error(f'Error loading token: {str(e)}')
-        raise SystemExit
+        async with WriterSession(host, port, token, sender,
+                                 credentials) as session:
+            while True:
+                batch = await sender.collect(messages_queue)
+                # None marks the end of the input
+                finished = batch[-1] is None
+                if finished:
+                    batch.pop()
+                if batch:
+                    await session.send_batch(batch)
+                if finished:
+                    break
+        # raises whatever stopped the source early
+        await source
+    finally:
+        source.cancel()
+
+
+async def read_file_messages(path):
+    # '-' stands for stdin
+    import aiofiles
+
+    source = 0 if path == '-' else path
+    async with aiofiles.open(source, mode='r', closefd=path != '-') as f:
+        async for line in f:
+            yield line.rstrip('\n')
+
 
-    logging.debug('Logged in successfully')
+async def read_socket_messages(path):
+    messages_queue = asyncio.Queue()
 
+    async def handle_client(reader, writer):
+        async for line in LineReader(reader):
+            messages_queue.put_nowait(line)
+        writer.close()
 
-async def submit_message(host, port, token, message):
-    async with manage_socket(host, port) as (reader, writer):
-        await read_from_chat(reader)
-        await login(reader, writer, token)
-        await write_to_socket(writer, [message, '\n', '\n'])
-        logging.debug(f'Sent message: {message}')
+    server = await asyncio.start_unix_server(handle_client, path)
+    async with server:
+        while True:
+            yield await messages_queue.get()
+
+
+async def handle_daemon_client(reader, writer, messages_queue):
+    # answers "ok" for every line once the server confirmed it, in order
+    loop = asyncio.get_running_loop()
+    replies = asyncio.Queue()
+
+    async def reply():
+        while True:
+            delivered = await replies.get()
+            if delivered is None:
+                break
+            await delivered
+            writer.write(b'ok\n')
+            await writer.drain()
+
+    replier = asyncio.create_task(reply())
+    try:
+        async for line in LineReader(reader):
+            if not line:
+                continue
+            delivered = loop.create_future()
+            await messages_queue.put((line, delivered))
+            replies.put_nowait(delivered)
+        replies.put_nowait(None)
+        await replier
+    except OSError:
+        logging.debug('Daemon client went away')
+    finally:
+        replier.cancel()
+        writer.close()
+
+
+async def deliver(session, sender, messages, scheduler):
+    # retries until the messages are handed to a live connection
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await session.send_batch(messages, retries=0)
+            return
+        except OSError:
+            # a batch that reached the sender is resent with its unacked,
+            # a keepalive probe may have been queued after it
+            if messages and any(message is messages[-1]
+                                for message in sender.unacked):
+                messages = []
+            # only the first failure after a login ends a connection
+            uptime = 0
+            if session.connected_at is not None:
+                uptime = loop.time() - session.connected_at
+                session.connected_at = None
+            scheduler.on_disconnect(uptime)
+            delay = scheduler.next_delay()
+            logging.info(f'Reconnecting in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+
+async def serve_daemon(host, port, token, path, sender=None,
+                       credentials=None, check_interval=1.0, keepalive=None):
+    # One logged-in connection shared by every client of the UNIX socket.
+    # A message is acknowledged to its client only when the server confirms
+    # it, messages lost with a broken connection are sent again. Keepalive
+    # probes find a connection that went half-open.
+    from connection import Keepalive, ReconnectScheduler
+
+    sender = sender or BatchSender()
+    messages_queue = asyncio.Queue(maxsize=sender.batch_size * 4)
+    # the futures of messages handed to the sender, in sending order
+    waiting = deque()
+    sender.on_ack = lambda message: waiting.popleft().set_result(None)
+    scheduler = ReconnectScheduler()
+    keepalive = keepalive or Keepalive()
+
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_daemon_client(reader, writer,
+                                                    messages_queue),
+        path
+    )
+    logging.info(f'Writer daemon listens on {path}')
+    collecting = None
+    async with server, WriterSession(host, port, token, sender, credentials,
+                                     keepalive=keepalive) as session:
+        while True:
+            if collecting is None:
+                collecting = asyncio.create_task(
+                    sender.collect(messages_queue))
+            done, _ = await asyncio.wait({collecting}, timeout=check_interval)
+            messages = []
+            if done:
+                batch, collecting = collecting.result(), None
+                waiting.extend(delivered for _, delivered in batch)
+                messages = [message for message, _ in batch]
+            elif not sender.pending or not session.writer or \
+                    not session.writer.is_closing():
+                # with nothing new reconnect only to resend unconfirmed ones
+                continue
+            await deliver(session, sender, messages, scheduler)
 
 
 if __name__ == '__main__':
-    parser = configargparse.ArgParser()
+    from envparse import ArgParser
+
+    parser = ArgParser()
     parser.add_argument(
         '--host', type=str, help='Host address',
         env_var='WRITER_HOST', default='minechat.dvmn.org'
@@ -72,10 +306,57 @@ if __name__ == '__main__':
         help='Personal hash to connect as an existing user', env_var='TOKEN'
     )
     parser.add_argument(
+        '--profile', type=str,
+        help='Use the token saved for this profile in .token.<profile>',
+        env_var='PROFILE'
+    )
+    add_send_arguments(parser)
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument(
         '--message', type=str,
-        help='Message to send', required=True
+        help='Message to send'
+    )
+    sources.add_argument(
+        '--file', type=str,
+        help='Send every line of the file as a message, - for stdin'
+    )
+    sources.add_argument(
+        '--socket', type=str,
+        help='Listen on a UNIX socket and send every received line'
+    )
+    sources.add_argument(
+        '--daemon', type=str,
+        help='Keep one connection and send lines from clients of this UNIX '
+             'socket, confirming each delivered one'
+    )
+    parser.add_argument(
+        '--via_daemon', type=str,
+        help='Hand --message or --file to the writer daemon on this UNIX '
+             'socket instead of logging in, WRITER_DAEMON is used only with '
+             '--message or --file'
     )
     args = parser.parse_args()
+    # the daemon itself and daemon_client.py read WRITER_DAEMON as well
+    if args.via_daemon is None and (args.message is not None or args.file):
+        import os
+
+        args.via_daemon = os.environ.get('WRITER_DAEMON')
+
+    if args.via_daemon:
+        if not (args.message or args.file):
+            parser.error('--via_daemon works with --message or --file')
+        import sys
+
+        from daemon_client import post_or_exit
+
+        if args.message:
+            messages = [args.message]
+        else:
+            source = sys.stdin if args.file == '-' else open(args.file)
+            with source:
+                messages = [line.rstrip('\n') for line in source]
+        post_or_exit(args.via_daemon, messages)
+        sys.exit()
 
     logging.basicConfig(
         format=(
@@ -85,4 +366,20 @@ if __name__ == '__main__':
         level=logging.DEBUG
     )
 
-    asyncio.run(submit_message(args.host, args.port, args.token, args.message))
+    sender = BatchSender(args.send_batch_size, args.send_high_water,
+                         args.send_rate_limit)
+    credentials = Credentials(args.profile)
+
+    if args.daemon:
+        asyncio.run(serve_daemon(args.host, args.port, args.token,
+                                 args.daemon, sender, credentials))
+    elif args.message:
+        asyncio.run(submit_message(args.host, args.port, args.token,
+                                   args.message, sender, credentials))
+    else:
+        if args.file:
+            messages = read_file_messages(args.file)
+        else:
+            messages = read_socket_messages(args.socket)
+        asyncio.run(submit_messages(args.host, args.port, args.token,
+                                    messages, sender, credentials))